@@ -0,0 +1,69 @@
+"""
+config_memory.py
+
+Measure how much memory a ConfigFile holds for a large synthetic config,
+and how much lookups of options that don't exist add on top. Each case
+runs in a fresh interpreter and reports the growth of its resident set.
+
+    $ python bench/config_memory.py [sections] [options_per_section] [missing_lookups]
+"""
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCH, "..", "src", "py")
+
+SECTIONS = 500
+OPTIONS = 100
+MISSING = 50000
+
+CHILD = """
+import os, sys, gc, json
+sys.path.insert(0, %(src)r)
+from daemonhelper.config import ConfigFile
+
+def rss():
+    with open("/proc/self/statm") as fd:
+        return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+gc.collect()
+before = rss()
+config = ConfigFile(%(path)r)
+gc.collect()
+loaded = rss()
+for i in xrange(%(missing)d):
+    config("section%%d" %% (i %% %(sections)d), "missing%%d" %% i, "default")
+gc.collect()
+looked_up = rss()
+print json.dumps({"loaded": loaded - before, "missing_lookups": looked_up - loaded})
+"""
+
+def run(sections=SECTIONS, options=OPTIONS, missing=MISSING):
+    sys.path.insert(0, BENCH)
+    import config_reload
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        config_reload.write(path, config_reload.make_text(sections, options))
+        out = subprocess.check_output([sys.executable, "-c", CHILD % {
+            "src": SRC, "path": path, "sections": sections, "missing": missing}])
+    finally:
+        os.unlink(path)
+    result = json.loads(out)
+    result.update(sections=sections, options=sections * options, missing=missing,
+            bytes_per_option=float(result["loaded"]) / (sections * options))
+    return result
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:4]]
+    result = run(*args)
+    print "%d options in %d sections" % (result["options"], result["sections"])
+    print "loaded           %8.1f MB  (%.0f bytes/option)" % (result["loaded"] / 1048576.0,
+            result["bytes_per_option"])
+    print "%d missing lookups %6.1f MB" % (result["missing"], result["missing_lookups"] / 1048576.0)
+
+if __name__ == "__main__":
+    main()
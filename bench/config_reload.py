@@ -0,0 +1,89 @@
+"""
+config_reload.py
+
+Time ConfigFile.update() on large synthetic configs: a forced full reload
+(what every update used to cost), an untouched file (stat fast path), a
+rewritten but identical file (content hash) and a single changed section.
+
+    $ python bench/config_reload.py [sections] [options_per_section]
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "py"))
+
+from daemonhelper.config import ConfigFile
+
+SIZES = [(10, 100), (100, 50), (200, 100)]
+REPEAT = 20
+
+def make_text(sections, options, changed=None):
+    lines = []
+    for s in range(sections):
+        lines.append("[section%d]" % s)
+        for o in range(options):
+            value = "value-%d-%d" % (s, o)
+            if s == changed and o == 0:
+                value += "-changed"
+            lines.append("option%d: %s" % (o, value))
+        lines.append("")
+    return "\n".join(lines)
+
+def write(path, text, age=0):
+    with open(path, "w") as fd:
+        fd.write(text)
+    if age:
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+
+def timed(func, repeat=REPEAT):
+    started = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - started) / repeat
+
+def run_size(sections, options):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        base = make_text(sections, options)
+        write(path, base, age=60)
+        config = ConfigFile(path)
+        config.update()
+        result = {"sections": sections, "options": sections * options}
+
+        result["forced"] = timed(lambda: config.update(force=True))
+        result["unchanged_stat"] = timed(config.update)
+
+        def rewrite_same():
+            write(path, base)
+            config.update()
+        result["unchanged_content"] = timed(rewrite_same)
+
+        texts = [make_text(sections, options, changed=0), base]
+        def change_one():
+            write(path, texts[0])
+            config.update()
+            texts.reverse()
+        result["one_section_changed"] = timed(change_one)
+        return result
+    finally:
+        os.unlink(path)
+
+def run(sizes=SIZES):
+    return [run_size(sections, options) for sections, options in sizes]
+
+def main():
+    sizes = SIZES
+    if len(sys.argv) > 2:
+        sizes = [(int(sys.argv[1]), int(sys.argv[2]))]
+    cases = ["forced", "unchanged_stat", "unchanged_content", "one_section_changed"]
+    print "%8s %8s" % ("sections", "options") + "".join("%22s" % case for case in cases)
+    for result in run(sizes):
+        print "%8d %8d" % (result["sections"], result["options"]) + \
+                "".join("%20.3fms" % (result[case] * 1000) for case in cases)
+
+if __name__ == "__main__":
+    main()
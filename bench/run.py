@@ -0,0 +1,267 @@
+"""
+run.py
+
+Run the daemonhelper benchmark suite and write the results as JSON, so runs
+can be compared across versions:
+
+- lifecycle: daemonize() time to ready, and start/stop/restart latency of a
+  stand-in daemon driven through its make_main script
+- config: ConfigFile.update() against config size and callbacks per option
+- logging: cost of one self.logger call with the default handlers, sync
+  and async
+- wrapper: WrapperDaemon output capture throughput
+
+Nothing needs root: the daemons use a temporary directory in place of /etc
+and /var through SYSTEM_CONFIG_BASE and SYSTEM_DATA_BASE, and syslog goes
+to UDP 127.0.0.1.
+
+    $ python bench/run.py [-o results.json] [--compare old.json] [--quick]
+"""
+import os
+import re
+import pwd
+import grp
+import sys
+import json
+import time
+import shutil
+import logging
+import optparse
+import platform
+import tempfile
+import subprocess
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCH, "..", "src", "py")
+sys.path.insert(0, SRC)
+
+from daemonhelper.base import Daemon
+from daemonhelper.config import ConfigFile
+import config_reload
+import wrapper_throughput
+
+DAEMON = """
+import sys, time
+sys.path.insert(0, %(src)r)
+from daemonhelper import Daemon, make_main
+
+class BenchDaemon(Daemon):
+    name = "benchd"
+    SYSTEM_CONFIG_BASE = %(etc)r
+    SYSTEM_DATA_BASE = %(var)r
+
+    def handle_run(self):
+        while True:
+            time.sleep(1)
+
+make_main(BenchDaemon)()
+"""
+
+# Run as whoever runs the benchmark, so starting the daemon needs no root
+RUN_AS_CONFIG = "[daemon]\nuser: %s\ngroup: %s\n" % (pwd.getpwuid(os.getuid()).pw_name,
+        grp.getgrgid(os.getgid()).gr_name)
+LOGGING_CONFIG = RUN_AS_CONFIG + "[logging]\nsyslog_host: 127.0.0.1\n"
+
+class StandIn(object):
+    """Temporary /etc and /var for a daemon named benchd."""
+    def __init__(self, config=LOGGING_CONFIG):
+        self.root = tempfile.mkdtemp(prefix="daemonhelper-bench-")
+        self.etc = os.path.join(self.root, "etc")
+        self.var = os.path.join(self.root, "var")
+        os.makedirs(self.etc)
+        for name in ["run", "lib"]:
+            os.makedirs(os.path.join(self.var, name))
+        with open(os.path.join(self.etc, "benchd.conf"), "w") as fd:
+            fd.write(config)
+        self.script = os.path.join(self.root, "benchd.py")
+        with open(self.script, "w") as fd:
+            fd.write(DAEMON % {"src": SRC, "etc": self.etc, "var": self.var})
+
+    def call(self, action):
+        """Run an action of the daemon's script, return (seconds, stderr)."""
+        started = time.time()
+        process = subprocess.Popen([sys.executable, self.script, action],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        return time.time() - started, err
+
+    def daemon_class(self):
+        return type("BenchDaemon", (Daemon,), {"name": "benchd",
+            "SYSTEM_CONFIG_BASE": self.etc, "SYSTEM_DATA_BASE": self.var})
+
+    def close(self):
+        shutil.rmtree(self.root)
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "min"    : samples[0],
+        "median" : samples[len(samples) // 2],
+        "max"    : samples[-1],
+    }
+
+# LIFECYCLE
+
+def bench_lifecycle(cycles):
+    stand_in = StandIn()
+    ready, start, stop, restart = [], [], [], []
+    try:
+        for _ in range(cycles):
+            elapsed, err = stand_in.call("start")
+            match = re.search(r"ready in ([0-9.]+)s", err)
+            if not match:
+                raise RuntimeError("start failed: %s" % err.strip())
+            ready.append(float(match.group(1)))
+            start.append(elapsed)
+            restart.append(stand_in.call("restart")[0])
+            stop.append(stand_in.call("stop")[0])
+    finally:
+        stand_in.call("stop")
+        stand_in.close()
+    return {
+        "daemonize_ready" : summarize(ready),
+        "start"           : summarize(start),
+        "restart"         : summarize(restart),
+        "stop"            : summarize(stop),
+    }
+
+# CONFIG
+
+def bench_config(option_counts, callback_counts, repeat):
+    results = []
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for options in option_counts:
+            sections = max(1, options // 100)
+            texts = [config_reload.make_text(sections, options // sections),
+                     config_reload.make_text(sections, options // sections).replace("value-", "other-")]
+            for callbacks in callback_counts:
+                config_reload.write(path, texts[0])
+                config = ConfigFile(path)
+                for section in range(sections):
+                    for option in range(options // sections):
+                        for _ in range(callbacks):
+                            config("section%d" % section, "option%d" % option, update_cb=_ignore)
+                def change_all():
+                    texts.reverse()
+                    config_reload.write(path, texts[0])
+                    config.update()
+                results.append({
+                    "options"   : options,
+                    "callbacks" : callbacks,
+                    "unchanged" : config_reload.timed(config.update, repeat),
+                    "changed"   : config_reload.timed(change_all, repeat),
+                })
+    finally:
+        os.unlink(path)
+    return results
+
+def _ignore(value):
+    pass
+
+# LOGGING
+
+def bench_logging(calls):
+    results = {}
+    for name, config in [("sync", LOGGING_CONFIG), ("async", LOGGING_CONFIG + "async: yes\n")]:
+        stand_in = StandIn(config)
+        root = logging.getLogger()
+        saved_handlers, saved_stderr = root.handlers[:], sys.stderr
+        root.handlers = []
+        sys.stderr = open(os.devnull, "w")
+        try:
+            daemon = stand_in.daemon_class()()
+            started = time.time()
+            for i in xrange(calls):
+                daemon.logger.info("benchmark record %d", i)
+            called = time.time()
+            for handler in root.handlers:
+                handler.flush()
+            drained = time.time()
+            results[name] = {
+                "per_call"   : (called - started) / calls,
+                "per_record" : (drained - started) / calls,
+            }
+        finally:
+            for handler in root.handlers:
+                handler.close()
+            root.handlers = saved_handlers
+            sys.stderr.close()
+            sys.stderr = saved_stderr
+            stand_in.close()
+    return results
+
+# SUITE
+
+def run(quick=False):
+    if quick:
+        cycles, option_counts, callback_counts, repeat, calls, lines = 3, [100, 1000], [0, 1], 3, 5000, 50000
+    else:
+        cycles, option_counts, callback_counts, repeat, calls, lines = 10, [100, 1000, 10000], [0, 1, 10], 10, 50000, 500000
+    return {
+        "meta" : {
+            "python"   : platform.python_version(),
+            "platform" : platform.platform(),
+            "revision" : _revision(),
+            "time"     : time.time(),
+            "quick"    : quick,
+        },
+        "lifecycle" : bench_lifecycle(cycles),
+        "config"    : bench_config(option_counts, callback_counts, repeat),
+        "logging"   : bench_logging(calls),
+        "wrapper"   : wrapper_throughput.run(lines),
+    }
+
+def _revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH,
+                stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Inputs recorded next to the measurements, left out of comparisons
+PARAMETERS = set(["options", "callbacks", "lines", "meta"])
+
+def flatten(results, prefix=""):
+    """{"lifecycle.start.median": 0.1, ...} for every number in the results."""
+    flat = {}
+    if isinstance(results, dict):
+        items = results.iteritems()
+    elif isinstance(results, list):
+        items = (("%s/%s" % (item.get("options"), item.get("callbacks")), item) for item in results)
+    else:
+        return {prefix: results}
+    for key, value in items:
+        if key in PARAMETERS:
+            continue
+        if isinstance(value, (dict, list)) or (isinstance(value, (int, float)) and not isinstance(value, bool)):
+            flat.update(flatten(value, prefix and "%s.%s" % (prefix, key) or key))
+    return flat
+
+def compare(old, new):
+    old, new = flatten(old), flatten(new)
+    for key in sorted(set(old) & set(new)):
+        if old[key]:
+            print "%-50s %12.6g %12.6g %7.2fx" % (key, old[key], new[key], float(new[key]) / old[key])
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-o", "--output", help="write the JSON results here instead of stdout")
+    parser.add_option("--compare", metavar="OLD", help="print new/old ratios against an earlier result file")
+    parser.add_option("--quick", action="store_true", help="smaller sizes and fewer repeats")
+    options, _ = parser.parse_args()
+
+    results = run(options.quick)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as fd:
+            fd.write(text + "\n")
+    else:
+        print text
+    if options.compare:
+        with open(options.compare) as fd:
+            compare(json.load(fd), results)
+
+if __name__ == "__main__":
+    main()
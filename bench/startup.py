@@ -0,0 +1,129 @@
+"""
+startup.py
+
+Time what every init script invocation pays before doing any work: a bare
+`import daemonhelper`, and a stand-in daemon's `make_main(...)` running
+`status` end to end. Each is the median over fresh interpreters, less the
+cost of starting an empty interpreter. Where the interpreter supports
+`-X importtime` (Python 3.7+) the slowest imports are listed too.
+
+Exits with status 1 when either time is over its budget.
+
+    $ python bench/startup.py [--import-budget ms] [--status-budget ms] [--repeat n]
+"""
+import os
+import sys
+import pwd
+import grp
+import time
+import shutil
+import optparse
+import tempfile
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "py")
+
+REPEAT = 15
+IMPORT_BUDGET = 100
+STATUS_BUDGET = 150
+
+DAEMON = """
+import sys
+sys.path.insert(0, %(src)r)
+from daemonhelper import Daemon, make_main
+
+class BenchDaemon(Daemon):
+    name = "benchd"
+    SYSTEM_CONFIG_BASE = %(etc)r
+    SYSTEM_DATA_BASE = %(var)r
+
+make_main(BenchDaemon)()
+"""
+
+def median_run(args, repeat, env=None):
+    """Median wall time of running args to completion."""
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            started = time.time()
+            subprocess.call(args, stdout=devnull, stderr=devnull, env=env)
+            times.append(time.time() - started)
+    return sorted(times)[len(times) // 2]
+
+def interpreter_time(repeat=REPEAT):
+    return median_run([sys.executable, "-c", "pass"], repeat)
+
+def import_time(repeat=REPEAT):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    return median_run([sys.executable, "-c", "import daemonhelper"], repeat, env)
+
+def status_time(repeat=REPEAT):
+    root = tempfile.mkdtemp()
+    try:
+        etc = os.path.join(root, "etc")
+        var = os.path.join(root, "var")
+        os.makedirs(etc)
+        os.makedirs(os.path.join(var, "run"))
+        with open(os.path.join(etc, "benchd.conf"), "w") as fd:
+            fd.write("[daemon]\nuser: %s\ngroup: %s\n[logging]\nsyslog_host: 127.0.0.1\n" %
+                    (pwd.getpwuid(os.getuid()).pw_name, grp.getgrgid(os.getgid()).gr_name))
+        script = os.path.join(root, "benchd.py")
+        with open(script, "w") as fd:
+            fd.write(DAEMON % {"src": SRC, "etc": etc, "var": var})
+        return median_run([sys.executable, script, "status"], repeat)
+    finally:
+        shutil.rmtree(root)
+
+def slowest_imports(count=10):
+    """[(cumulative us, module)] from -X importtime, or None where unsupported."""
+    if sys.version_info < (3, 7):
+        return None
+    env = dict(os.environ, PYTHONPATH=SRC)
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import daemonhelper"],
+            stderr=subprocess.PIPE, env=env)
+    _, err = process.communicate()
+    imports = []
+    for line in err.decode().splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split(":", 1)[1].split("|")
+        imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def run(repeat=REPEAT):
+    baseline = interpreter_time(repeat)
+    return {
+        "interpreter" : baseline,
+        "import"      : import_time(repeat) - baseline,
+        "status"      : status_time(repeat) - baseline,
+        "imports"     : slowest_imports(),
+    }
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--import-budget", type="float", default=IMPORT_BUDGET,
+            help="maximum ms for import daemonhelper (default %default)")
+    parser.add_option("--status-budget", type="float", default=STATUS_BUDGET,
+            help="maximum ms for make_main(...) status (default %default)")
+    parser.add_option("--repeat", type="int", default=REPEAT)
+    options, _ = parser.parse_args()
+
+    results = run(options.repeat)
+    print "interpreter  %7.1fms" % (results["interpreter"] * 1000)
+    over = []
+    for name, budget in [("import", options.import_budget), ("status", options.status_budget)]:
+        elapsed = results[name] * 1000
+        print "%-12s %7.1fms  (budget %.0fms)" % (name, elapsed, budget)
+        if elapsed > budget:
+            over.append(name)
+    if results["imports"] is None:
+        print "-X importtime needs Python 3.7+, no per-module breakdown"
+    else:
+        for cumulative, module in results["imports"]:
+            print "  %8.1fms  %s" % (cumulative / 1000.0, module)
+    if over:
+        print >>sys.stderr, "over budget: %s" % ", ".join(over)
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
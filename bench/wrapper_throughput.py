@@ -0,0 +1,100 @@
+"""
+wrapper_throughput.py
+
+Compare WrapperDaemon's output capture against the old readline() loop.
+A child prints LINES lines as fast as it can; both readers log every line
+to a handler that only counts records.
+
+    $ python bench/wrapper_throughput.py [lines]
+"""
+import os
+import sys
+import time
+import logging
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "py"))
+
+from daemonhelper.wrapper import OutputCapture, _Poller
+
+LINES = 500000
+CHILD = [sys.executable, "-c",
+    "import sys\n"
+    "out = sys.stdout\n"
+    "for i in xrange(%d): out.write('line %%d of some typical child output\\n' %% i)\n"]
+
+class CountingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+def make_logger():
+    logger = logging.getLogger("bench.wrapper")
+    logger.handlers = []
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = CountingHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+def spawn(lines):
+    args = list(CHILD)
+    args[-1] = args[-1] % lines
+    return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+def readline_loop(lines):
+    """The pre-OutputCapture WrapperDaemon loop."""
+    logger, handler = make_logger()
+    process = spawn(lines)
+    while True:
+        line = process.stdout.readline()
+        if not line:
+            break
+        line = line.rstrip()
+        if not line:
+            continue
+        logger.info(line)
+    process.wait()
+    return handler.count
+
+def capture_loop(lines):
+    logger, handler = make_logger()
+    process = spawn(lines)
+    poller = _Poller()
+    capture = OutputCapture(process.stdout.fileno(), logger)
+    poller.register(capture.fd, capture)
+    while capture.read():
+        poller.poll(1.0)
+    poller.unregister(capture.fd)
+    process.stdout.close()
+    process.wait()
+    return handler.count
+
+def measure(func, lines):
+    started = time.time()
+    count = func(lines)
+    elapsed = time.time() - started
+    assert count == lines, "%s logged %d of %d lines" % (func.__name__, count, lines)
+    return {"lines": count, "seconds": elapsed, "lines_per_second": count / elapsed}
+
+def run(lines=LINES):
+    return {
+        "readline": measure(readline_loop, lines),
+        "capture": measure(capture_loop, lines),
+    }
+
+def main():
+    lines = len(sys.argv) > 1 and int(sys.argv[1]) or LINES
+    results = run(lines)
+    for name in ["readline", "capture"]:
+        result = results[name]
+        print "%-10s %8d lines  %7.3fs  %10.0f lines/s" % (name, result["lines"],
+                result["seconds"], result["lines_per_second"])
+    print "speedup    %.2fx" % (results["capture"]["lines_per_second"] /
+            results["readline"]["lines_per_second"])
+
+if __name__ == "__main__":
+    main()
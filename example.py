@@ -1,4 +1,4 @@
-from daemonhelper import Daemon, make_main
+from daemonhelper import Daemon, ConfigSchema, make_main
 import time
 
 class MyDaemon(Daemon):
@@ -8,7 +8,8 @@ class MyDaemon(Daemon):
 
 	$ cat /etc/mydaemon.conf
 	[mydaemon]
-	value: lolcats
+	somevalue: lolcats
+	interval: 2s
 	
 	The config file may be changed, which the daemon will detect on SIGHUP:
 	$ # Config reload/polling is broken right now, will fix soon
@@ -27,16 +28,26 @@ class MyDaemon(Daemon):
 	name = "mydaemon"
 	description = "I'm so cool"
 
+	# Typed options, compiled into self.settings. Reading a Setting's value
+	# is a plain attribute load that only changes when the config does.
+	config_schema = ConfigSchema({
+		"mydaemon": {
+			"somevalue": ("str", "defaultvalue"),
+			"interval": ("duration", 2),
+		},
+	})
+
 	def handle_prerun(self):
 		self.logger.info("handle_prerun always runs as root")
 		self._shutdown = False
 
 	def handle_run(self):
 		self.logger.info("handle_run is run as a configured user (default is root)")
+		some_config_value = self.settings.mydaemon.somevalue
+		interval = self.settings.mydaemon.interval
 		while not self._shutdown:
-			some_config_value = self.config("mydaemon", "somevalue", "defaultvalue")
-			self.logger.info("ping! %r" % some_config_value)
-			time.sleep(2)
+			self.logger.info("ping! %r" % some_config_value.value)
+			time.sleep(interval.value)
 		self.logger.warning("oh no I'm totally dead!")
 
 	def handle_stop(self):
@@ -3,3 +3,4 @@ from daemonhelper.base import *
 from daemonhelper.exceptions import *
 from daemonhelper.wrapper import *
 from daemonhelper.config import *
+from daemonhelper.handlers import *
@@ -9,45 +9,93 @@ import sys
 import pwd
 import grp
 import time
+import json
 import errno
+import fcntl
 import signal
+import socket
 import logging
-import asyncore
+import resource
 import optparse
+import tempfile
+import threading
 import traceback
 import logging.handlers
 
-try:
-    import gevent
-    _USE_GEVENT = True
-except ImportError:
-    _USE_GEVENT = False
-
-try:
-    import pyinotify
-    _USE_PYINOTIFY = True
-except ImportError:
-    _USE_PYINOTIFY = False
-
-from daemonhelper.config import ConfigFile
-from daemonhelper.exceptions import DaemonStopped, DaemonRunning
+from daemonhelper.config import ConfigFile, to_bool, to_octal, to_duration
+from daemonhelper.handlers import QueueHandler, TCPSysLogHandler
+from daemonhelper.watcher import ConfigWatcher
+from daemonhelper.procutil import wait_for_exit, process_exists, module_available
+from daemonhelper.notify import ReadinessPipe, sd_notify
+from daemonhelper.control import ControlServer, ControlClient
+from daemonhelper.metrics import Registry, MetricsWriter
+from daemonhelper.profiling import PROFILERS, StackSampler
+from daemonhelper.tuning import Tuning
+from daemonhelper.signals import SignalQueue, signal_name
+from daemonhelper.exceptions import DaemonStopped, DaemonRunning, DaemonStartFailed, ControlError, ConfigError
+
+# Optional backends are imported on first use, so plain daemons and CLI
+# calls like status don't pay for them
+_USE_GEVENT = module_available("gevent")
+_USE_ASYNCIO = module_available("asyncio") or module_available("trollius")
+
+_LEVEL_NAMES = {
+    "critical" : logging.CRITICAL,
+    "error"    : logging.ERROR,
+    "warning"  : logging.WARNING,
+    "info"     : logging.INFO,
+    "debug"    : logging.DEBUG
+}
+
+# Environment handed to a replacement process by a graceful restart
+_FDS_ENV = "DAEMONHELPER_FDS"
+_HANDOFF_ENV = "DAEMONHELPER_HANDOFF_PID"
+_LOCK_ENV = "DAEMONHELPER_LOCK_FD"
 
 class Daemon(object):
     """
     A daemon with start/stop/etc, pidfile, and logging support.
 
-    Daemon config should exist in /etc/<daemon_name>.conf, for example:
+    Daemon config should exist in /etc/<daemon_name>.conf, with drop-in files
+    in /etc/<daemon_name>/*.conf merged on top of it in name order, for example:
 
     [daemon]
     user: <user_name_to_run_as>
     group: <group_name_to_run_as>
     umask: <octal umask>
+    workers: <number of pre-forked worker processes, or auto for one per CPU>
+    control_socket: <yes to serve commands on <pidfile_dir>/<daemon_name>.sock>
+    cpu_affinity: <CPUs to run on, e.g. 0-3,6>
+    nice: <niceness, -20 to 19>
+    ionice: <idle, best-effort[:0-7] or realtime[:0-7]>
+    sched_policy: <other|batch|idle|fifo|rr>
+    sched_priority: <1-99 for fifo and rr>
+    rlimit_nofile: <open files limit, <soft>:<hard> or one value for both>
+    rlimit_nproc: <processes limit>
+    rlimit_core: <core file size limit, 0 or unlimited>
+    oom_score_adj: <-1000 to 1000>
+    cgroup: <cgroup v2 path under /sys/fs/cgroup to move the daemon into>
+    cgroup_cpu_max: <cpu.max of that cgroup, e.g. 50000 100000>
+    cgroup_memory_max: <memory.max of that cgroup, e.g. 512M>
 
     [logging]
     level: <debug|info|warning>
     format: <see python logging module>
     syslog_host: <host to syslog to>
     syslog_port: <port to syslog to>
+    syslog_transport: <udp|tcp>
+    async: <yes to ship log records from a background thread>
+    queue_size: <max records waiting in the async queue>
+    overflow: <drop|block when the async queue is full>
+
+    [metrics]
+    export: <yes to write self.metrics to <state dir>/metrics.prom>
+    interval: <seconds between writes of the metrics file>
+
+    [profiling]
+    mode: <sample|cprofile, the profiler started by the profile signal>
+    duration: <seconds a profiling session lasts>
+    interval: <seconds of CPU time between stack samples>
     """
     SYSTEM_CONFIG_BASE = "/etc"
     SYSTEM_READONLY_BASE = "/usr"
@@ -57,11 +105,60 @@ class Daemon(object):
     description = ""
 
     autoreload = False
+    autoreload_debounce = 0.25
+    config_schema = None
     should_daemonize = True
     signal_alias = {}
 
+    control_socket = False
+    commands = {}
+
+    worker_index = None
+    worker_min_uptime = 1
+
+    graceful_restart_signal = signal.SIGTTIN
+    profile_signal = signal.SIGTTOU
+    # "thread" runs handle_update/handle_usr1/handle_usr2 on a dispatcher
+    # thread, concurrently with handle_run; "loop" runs them inside
+    # handle_run, which must then call self.sleep or self.dispatch_signals
+    signal_dispatch = "thread"
+
+    notify_ready_explicitly = False
+    ready_timeout = 30
+
+    export_metrics = False
+    metrics_interval = 15
+
+    _readiness = None
+    _control_server = None
+    _metrics_writer = None
+    _profiler = None
+    _profile_request = None
+    _launched_at = None
+    _signals = None
+    _pidfile = None
+    _lockfile = None
+    _started_at = None
+
     def __init__(self):
-        self.config = ConfigFile(self.config_path)
+        self.sockets = {}
+        self.metrics = Registry()
+        self._commands = {
+            "status"    : self._command_status,
+            "reload"    : self._command_reload,
+            "stats"     : self._command_stats,
+            "log-level" : self._command_log_level,
+            "profile"   : self._command_profile,
+        }
+        for name, method in self.commands.iteritems():
+            self.register_command(name, getattr(self, method))
+        self._exec_argv = [sys.executable, os.path.abspath(sys.argv[0])]
+        self._inherited_fds = self._parse_inherited_fds()
+        if _LOCK_ENV in os.environ:
+            self._lockfile = int(os.environ.pop(_LOCK_ENV))
+        self.config = ConfigFile(self.config_path, self.config_dir_path,
+                self.config_schema and [self.config_schema.validate] or ())
+        self.settings = self.config_schema and self.config_schema.compile(self.config)
         self._setup_logging()
 
     # PATHS
@@ -112,16 +209,51 @@ class Daemon(object):
         """Process pidfile path"""
         return os.path.join(self.pidfile_dir, "%s.pid" % self.name)
 
+    @property
+    def lockfile_path(self):
+        """Lock file held by the running daemon, kept between runs"""
+        return os.path.join(self.pidfile_dir, "%s.lock" % self.name)
+
     @property
     def pid(self):
-        """The value of the daemon process's pidfile"""
-        try:
-            return int(open(self.pidfile_path).read())
-        except IOError as ex:
-            if ex.args[0] == errno.ENOENT:
-                raise DaemonStopped()
-            else:
+        """
+        The value of the daemon process's pidfile, while the daemon runs.
+        A running daemon holds lockfile_path locked. A pidfile without the
+        lock held still counts while its pid is alive, as for a daemon
+        started before the lock file existed; otherwise it is stale and
+        removed. A pidfile replaced meanwhile, as by a graceful restart or
+        a new daemon, is probed again.
+        """
+        while True:
+            try:
+                fd = os.open(self.pidfile_path, os.O_RDONLY)
+            except OSError as ex:
+                if ex.args[0] == errno.ENOENT:
+                    raise DaemonStopped()
                 raise
+            try:
+                pid = int(os.read(fd, 32))
+                if self._lock_held() or process_exists(pid):
+                    return pid
+                if self._remove_stale_pidfile(fd):
+                    raise DaemonStopped()
+            finally:
+                os.close(fd)
+
+    @property
+    def state_dir(self):
+        """Daemon state directory"""
+        return os.path.join(self.sys_state_path, self.name)
+
+    @property
+    def metrics_path(self):
+        """Prometheus text file the metrics are exported to"""
+        return os.path.join(self.state_dir, "metrics.prom")
+
+    @property
+    def control_socket_path(self):
+        """Control socket path"""
+        return os.path.join(self.pidfile_dir, "%s.sock" % self.name)
 
     @property
     def config_path(self):
@@ -136,42 +268,81 @@ class Daemon(object):
     # DAEMON HELPERS
 
     def daemonize(self):
-        """Call the given callback in a new daemonized child process"""
-        self._prepare_daemon()
-        self._load_privileges()
-        self._make_pidfile_dir()
+        """
+        Call the given callback in a new daemonized child process.
+        In the launching process, returns once the daemon is ready, with the
+        seconds that took, or raises DaemonStartFailed.
+        """
+        self._check_config()
+        started = self._launched_at = time.time()
+        with self._startup_phase("prepare"):
+            self._prepare_daemon()
+            self._load_privileges()
+            self._make_pidfile_dir()
+            if self._metrics_export_enabled():
+                self._make_state_dir()
         
         # Fork child process (unless we run in foreground)
+        first_fork_retval = 0
         try:
             if self.should_daemonize:
+                self._readiness = ReadinessPipe()
+                forked = time.time()
                 first_fork_retval = self._fork()
-                if first_fork_retval > 0:
-                    return
-                os.setsid()
-                self._setup_std_pipes()
-                second_fork_retval = self._fork()
-                if second_fork_retval > 0:
-                    sys.exit(0)
+                if first_fork_retval == 0:
+                    self._readiness.close_read()
+                    os.setsid()
+                    self._setup_std_pipes()
+                    second_fork_retval = self._fork()
+                    if second_fork_retval > 0:
+                        sys.exit(0)
+                    self._startup_gauge("fork").set(time.time() - forked)
 
         # Unable to fork for some reason
         except Exception as ex:
             self.logger.error("Failed to fork daemon process")
             self.logger.exception(ex)
             raise SystemExit(1)
+
+        # Wait for the daemon to report back
+        if first_fork_retval > 0:
+            return self._wait_ready(started)
         
         # Run daemon
+        self._started_at = time.time()
         try:
             try:
                 self.logger.info("Started")
-                self.handle_prerun()
-                self._drop_privileges()
-                self._write_pidfile()
-                self._setup_signal_handlers()
-                if self.autoreload:
-                    self._setup_conf_watcher()
-                self._do_run()
+                with self._startup_phase("tuning"):
+                    self._apply_tuning()
+                with self._startup_phase("prerun"):
+                    self.handle_prerun()
+                with self._startup_phase("privileges"):
+                    self._drop_privileges()
+                    self._write_pidfile()
+                with self._startup_phase("signals"):
+                    self._setup_signal_handlers()
+                    signal.signal(self.graceful_restart_signal,
+                            self._timed_handler("graceful", self._graceful_restart))
+                    signal.signal(self.profile_signal, self._timed_handler("profile", self._toggle_profiling))
+                with self._startup_phase("services"):
+                    if self.autoreload:
+                        self._setup_conf_watcher()
+                    self._start_control_server()
+                    self._start_metrics_writer()
+                if not self.notify_ready_explicitly:
+                    self.notify_ready()
+                workers = self._worker_count()
+                if workers:
+                    self._run_workers(workers)
+                else:
+                    self._do_run()
                 self.logger.info("Stopped")
             finally:
+                if self._profiler is not None:
+                    self._stop_profiling()
+                self._stop_metrics_writer()
+                self._stop_control_server()
                 self._remove_pidfile()
 
         # Log normal exits                
@@ -181,20 +352,78 @@ class Daemon(object):
                 self.logger.info("Stopped")
             else:
                 self.logger.warning("Stopped with code %d" % errcode)
+                self._notify_failed("stopped with code %d" % errcode)
             raise
 
         # Log abnormal exits
         except Exception as ex:
             self.logger.error("Killed by uncaught exception")
             self.logger.exception(ex)
+            self._notify_failed("%s: %s" % (ex.__class__.__name__, ex))
             raise SystemExit(1)
 
+        finally:
+            self._flush_logging()
+
+    def _check_config(self):
+        """Refuse to go on with a config that failed to load."""
+        if self.config.error is not None:
+            raise DaemonStartFailed("invalid config: %s" % self.config.error)
+
+    def notify_ready(self):
+        """
+        Report that the daemon is serving. This unblocks the `start` that
+        launched it, sends READY=1 to systemd when NOTIFY_SOCKET is set, and
+        tells the process replaced by a graceful restart to exit.
+        Called right after handle_prerun unless notify_ready_explicitly is
+        set, in which case handle_run should call it.
+        """
+        if self._readiness is not None:
+            self._readiness.ready()
+            self._readiness = None
+        if self._launched_at is not None:
+            self._startup_gauge("ready").set(time.time() - self._launched_at)
+        try:
+            sd_notify("READY=1\nMAINPID=%d" % os.getpid())
+        except socket.error as ex:
+            self.logger.warning("Could not notify systemd: %s" % ex)
+        self._finish_handoff()
+
+    def _notify_failed(self, reason):
+        """Pass a startup failure back to the launching process."""
+        if self._readiness is not None:
+            self._readiness.failed(reason)
+            self._readiness = None
+
+    def _wait_ready(self, started):
+        """Wait in the launching process until the daemon reports ready."""
+        readiness, self._readiness = self._readiness, None
+        readiness.close_write()
+        ready, reason = readiness.wait(self.ready_timeout)
+        if not ready:
+            raise DaemonStartFailed(reason)
+        return time.time() - started
+
     def _prepare_daemon(self):
         """Set the umask and chdir to root in preparation."""
-        umask = self.config("daemon", "umask", 0007, transform=lambda x: int(x, 8))
+        umask = self.config("daemon", "umask", 0007, transform=to_octal)
         os.umask(umask)
         os.chdir("/")
 
+    def _make_state_dir(self):
+        """Make the state directory, owned by the daemon's user"""
+        if not os.path.exists(self.state_dir):
+            os.mkdir(self.state_dir, 0750)
+        os.lchown(self.state_dir, self._use_uid, self._use_gid)
+
+    def _apply_tuning(self):
+        """
+        Apply the [daemon] resource tuning options. This runs before
+        handle_prerun, while still privileged, so raised limits and
+        priorities are allowed and every thread and child inherits them.
+        """
+        Tuning(self.config).apply(self.logger)
+
     def _setup_std_pipes(self):
         """Duplicate /dev/null's fd over stdin, stdout, and stderr"""
         devnull = open("/dev/null", "r+")
@@ -216,34 +445,395 @@ class Daemon(object):
         return os.fork()
 
     def _write_pidfile(self):
-        """Insert PID into pidfile_path"""
-        pidfile = open(self.pidfile_path, "w")
-        pidfile.write(str(os.getpid()))
+        """
+        Lock lockfile_path until we exit, then atomically replace
+        pidfile_path with a file holding our PID. A graceful restart hands
+        the lock to its replacement, which renames its own pidfile over ours.
+        @raise DaemonRunning if another daemon holds the lock
+        """
+        if self._lockfile is None:
+            self._lockfile = self._lock()
+        fd, path = tempfile.mkstemp(prefix=".%s.pid." % self.name, dir=self.pidfile_dir)
+        try:
+            os.fchmod(fd, 0644)
+            os.write(fd, str(os.getpid()))
+            os.rename(path, self.pidfile_path)
+        except:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        self._pidfile = fd
+
+    def _lock(self):
+        """Open and exclusively lock lockfile_path, returning its fd."""
+        fd = os.open(self.lockfile_path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        # A status probe holds the lock for an instant, so retry briefly
+        deadline = time.time() + 1
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except IOError as ex:
+                if ex.args[0] != errno.EWOULDBLOCK:
+                    os.close(fd)
+                    raise
+                if time.time() >= deadline:
+                    os.close(fd)
+                    raise DaemonRunning()
+            time.sleep(0.01)
+
+    def _lock_held(self):
+        """Tell with one non-blocking lock attempt whether a daemon holds lockfile_path."""
+        try:
+            fd = os.open(self.lockfile_path, os.O_RDONLY)
+        except OSError as ex:
+            if ex.args[0] == errno.ENOENT:
+                return False
+            raise
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as ex:
+            if ex.args[0] != errno.EWOULDBLOCK:
+                raise
+            return True
+        finally:
+            os.close(fd)
+        return False
 
     def _remove_pidfile(self):
-        """Attempt to remove the pidfile"""
+        """
+        Attempt to remove the pidfile, unless a replacement process owns
+        it, then release the lock, unless a replacement shares it.
+        """
+        if self._pidfile is not None:
+            try:
+                if os.fstat(self._pidfile).st_ino == os.stat(self.pidfile_path).st_ino:
+                    os.unlink(self.pidfile_path)
+            except OSError as ex:
+                if ex.args[0] != errno.ENOENT:
+                    self.logger.warning("Could not remove pidfile")
+                    self.logger.exception(ex)
+            finally:
+                os.close(self._pidfile)
+                self._pidfile = None
+        if self._lockfile is not None:
+            os.close(self._lockfile)
+            self._lockfile = None
+
+    def _remove_stale_pidfile(self, fd):
+        """
+        Remove the pidfile open as fd, unless it was just replaced.
+        @return False if pidfile_path now holds another file
+        """
         try:
+            if os.fstat(fd).st_ino != os.stat(self.pidfile_path).st_ino:
+                return False
             os.unlink(self.pidfile_path)
+            self.logger.warning("Removed stale pidfile %s" % self.pidfile_path)
         except OSError as ex:
-            self.logger.warning("Could not remove pidfile")
-            self.logger.exception(ex)
+            if ex.args[0] not in (errno.ENOENT, errno.EACCES, errno.EPERM):
+                raise
+        return True
 
     def _setup_signal_handlers(self):
-        """Map each signal to a function in the daemon class"""
-        signal.signal(signal.SIGINT, lambda *_: self.handle_stop())
-        signal.signal(signal.SIGTERM, lambda *_: self.handle_stop())
-        signal.signal(signal.SIGHUP, lambda *_: self.handle_update())
-        signal.signal(signal.SIGUSR1, lambda *_: self.handle_usr1())
-        signal.signal(signal.SIGUSR2, lambda *_: self.handle_usr2())
+        """
+        Map each signal to a function in the daemon class.
+        SIGINT and SIGTERM are handled on arrival. SIGHUP, SIGUSR1 and
+        SIGUSR2 are queued and their handlers run once per batch of pending
+        signals: from a background thread when signal_dispatch is "thread"
+        (the default), concurrently with handle_run, otherwise from the run
+        loop through self.sleep or self.dispatch_signals.
+        """
+        signal.signal(signal.SIGINT, self._timed_handler("SIGINT", self.handle_stop))
+        signal.signal(signal.SIGTERM, self._timed_handler("SIGTERM", self.handle_stop))
+        self._queue_signals({
+            signal.SIGHUP  : self.handle_update,
+            signal.SIGUSR1 : self.handle_usr1,
+            signal.SIGUSR2 : self.handle_usr2,
+        })
+
+    def _queue_signals(self, handlers):
+        """Route {signum: func} through a new SignalQueue, replacing any previous one."""
+        previous = self._signals
+        self._signals = SignalQueue(self.metrics, self.logger)
+        for signum, func in handlers.iteritems():
+            self._signals.register(signum, self._timed_handler(signal_name(signum), func))
+        if previous is not None:
+            previous.close()
+
+    @property
+    def signal_fileno(self):
+        """Readable when queued signals are waiting for dispatch_signals."""
+        return self._signals.fileno()
+
+    def dispatch_signals(self):
+        """Run the handlers of queued signals, a safe point for run loops."""
+        if self._signals is not None:
+            self._signals.dispatch()
+
+    def sleep(self, seconds):
+        """time.sleep for handle_run loops, dispatching queued signals meanwhile."""
+        if self._signals is None:
+            time.sleep(seconds)
+        else:
+            self._signals.sleep(seconds)
+
+    # METRICS
+
+    def _startup_gauge(self, phase):
+        return self.metrics.gauge("daemon_startup_seconds",
+                "Seconds spent in each startup phase", phase=phase)
+
+    def _startup_phase(self, phase):
+        """Context manager recording the duration of a startup phase."""
+        return self._startup_gauge(phase).time()
+
+    def _timed_handler(self, name, func):
+        """Wrap func as a signal handler recording how long it runs."""
+        histogram = self.metrics.histogram("daemon_signal_handler_seconds",
+                "Seconds spent handling each signal", signal=name)
+        def handler(*_):
+            with histogram.time():
+                return func()
+        return handler
+
+    def _metrics_export_enabled(self):
+        return self.config("metrics", "export", self.export_metrics, transform=to_bool)
+
+    def _start_metrics_writer(self):
+        if not self._metrics_export_enabled():
+            return
+        interval = self.config("metrics", "interval", self.metrics_interval, transform=to_duration)
+        self._metrics_writer = MetricsWriter(self.metrics, self.metrics_path, interval, self.logger)
+        self._metrics_writer.start()
+
+    def _stop_metrics_writer(self):
+        if self._metrics_writer is not None:
+            self._metrics_writer.stop()
+            self._metrics_writer = None
+
+    # CONTROL SOCKET
+
+    def register_command(self, name, func):
+        """
+        Serve func(*args) as a control socket command. Commands run on the
+        control socket's thread and must return JSON serializable values.
+        Use the commands class attribute ({name: method name}) to do the
+        same declaratively.
+        """
+        self._commands[name] = func
+
+    def _control_enabled(self):
+        return self.config("daemon", "control_socket", self.control_socket, transform=to_bool)
+
+    def _start_control_server(self):
+        if not self._control_enabled():
+            return
+        self._control_server = ControlServer(self.control_socket_path, self._commands)
+        self._control_server.start()
+
+    def _stop_control_server(self):
+        if self._control_server is not None:
+            self._control_server.close()
+            self._control_server = None
+
+    def control(self, command, *args):
+        """
+        Run a command in the running daemon over its control socket.
+        @raise DaemonStopped if no daemon is running
+        @raise ControlError if it runs without a control socket
+        """
+        try:
+            client = ControlClient(self.control_socket_path)
+        except socket.error:
+            if not self.status:
+                raise DaemonStopped()
+            if not os.path.exists(self.control_socket_path):
+                raise ControlError("Daemon is running with its control socket disabled")
+            raise ControlError("Daemon is running but its control socket is not answering")
+        try:
+            return client.call(command, *args)
+        finally:
+            client.close()
+
+    def _command_status(self):
+        return {
+            "name"    : self.name,
+            "pid"     : os.getpid(),
+            "uptime"  : time.time() - self._started_at,
+            "workers" : sorted(getattr(self, "_workers", {})),
+        }
+
+    def _command_reload(self):
+        os.kill(os.getpid(), signal.SIGHUP)
+        return True
+
+    def _command_stats(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "uptime"       : time.time() - self._started_at,
+            "threads"      : threading.active_count(),
+            "user_time"    : usage.ru_utime,
+            "system_time"  : usage.ru_stime,
+            "max_rss_kb"   : usage.ru_maxrss,
+            "log_dropped"  : sum(getattr(handler, "dropped", 0) for handler in logging.getLogger().handlers),
+            "metrics"      : self.metrics.collect(),
+        }
+
+    def _command_log_level(self, level=None):
+        logger = logging.getLogger()
+        if level is not None:
+            logger.setLevel(_LEVEL_NAMES[level.lower()])
+        return logging.getLevelName(logger.level).lower()
+
+    def _command_profile(self, seconds=None, mode=None):
+        if self._profiler is not None:
+            raise ControlError("Already profiling")
+        seconds, mode, path = self._profile_request = self._profile_options(seconds, mode)
+        os.kill(os.getpid(), self.profile_signal)
+        if getattr(self, "_workers", None):
+            # Forwarded: every worker profiles itself with the [profiling] defaults
+            return {"workers": sorted(self._workers)}
+        return {"mode": mode, "seconds": seconds, "path": path}
+
+    # PROFILING
+
+    def _profile_options(self, seconds=None, mode=None):
+        """(seconds, mode, output path) of a session, defaulting to [profiling]."""
+        mode = (mode or self.config("profiling", "mode", "sample")).lower()
+        if mode not in PROFILERS:
+            raise ValueError("Unknown profiler '%s'" % mode)
+        if seconds is None:
+            seconds = self.config("profiling", "duration", 30, transform=to_duration)
+        filename = "profile-%d-%s.%s" % (os.getpid(), time.strftime("%Y%m%d-%H%M%S"),
+                PROFILERS[mode].extension)
+        return float(seconds), mode, os.path.join(self.state_dir, filename)
+
+    def _toggle_profiling(self):
+        """
+        Handle the profile signal: start a session, or end the running one
+        early. The session profiles the main thread, where handle_run runs,
+        and is written under state_dir when it ends.
+        """
+        if self._profiler is not None:
+            self._stop_profiling()
+            return
+        request, self._profile_request = self._profile_request, None
+        seconds, mode, path = request or self._profile_options()
+        if mode == "sample":
+            profiler = StackSampler(self.config("profiling", "interval", 0.005, transform=to_duration))
+        else:
+            profiler = PROFILERS[mode]()
+        profiler.start()
+        self._profiler, self._profile_path = profiler, path
+        self.logger.info("Profiling (%s) for %gs" % (mode, seconds))
+        timer = threading.Timer(seconds, self._end_profiling, (profiler,))
+        timer.daemon = True
+        timer.start()
+
+    def _end_profiling(self, profiler):
+        """Have the main thread stop profiler, unless that already happened."""
+        if self._profiler is profiler:
+            os.kill(os.getpid(), self.profile_signal)
+
+    def _stop_profiling(self):
+        profiler, self._profiler = self._profiler, None
+        profiler.stop()
+        try:
+            if not os.path.isdir(self.state_dir):
+                os.makedirs(self.state_dir, 0750)
+            profiler.write(self._profile_path)
+            self.logger.info("Wrote profile to %s" % self._profile_path)
+        except (IOError, OSError) as ex:
+            self.logger.error("Could not write profile: %s" % ex)
+
+    # GRACEFUL RESTART
+
+    def listen_socket(self, name, address, family=None, type=socket.SOCK_STREAM, backlog=128):
+        """
+        Open a listening socket in handle_prerun, registered as self.sockets[name].
+        A process started by a graceful restart gets the previous process's
+        socket of the same name instead, so no connection is refused while
+        the daemon is replaced. A string address means a unix socket.
+        """
+        if family is None:
+            family = isinstance(address, basestring) and socket.AF_UNIX or socket.AF_INET
+        fd = self._inherited_fds.pop(name, None)
+        if fd is not None:
+            sock = socket.fromfd(fd, family, type)
+            os.close(fd)
+        else:
+            sock = socket.socket(family, type)
+            if family == socket.AF_UNIX:
+                if os.path.exists(address):
+                    os.unlink(address)
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(address)
+            sock.listen(backlog)
+        self.sockets[name] = sock
+        return sock
+
+    def _parse_inherited_fds(self):
+        """Read the name=fd list a graceful restart left in the environment."""
+        fds = {}
+        for item in os.environ.pop(_FDS_ENV, "").split(","):
+            if "=" in item:
+                name, fd = item.split("=", 1)
+                fds[name] = int(fd)
+        return fds
+
+    def _graceful_restart(self):
+        """
+        Start a replacement process which inherits self.sockets. Once it is
+        ready it sends us SIGTERM, so we drain and exit.
+        """
+        if self.worker_index is not None:
+            return
+        self.logger.info("Graceful restart: starting replacement process")
+        env = dict(os.environ)
+        env[_FDS_ENV] = ",".join("%s=%d" % (name, sock.fileno())
+                for name, sock in self.sockets.iteritems())
+        env[_HANDOFF_ENV] = str(os.getpid())
+        env[_LOCK_ENV] = str(self._lockfile)
+        pid = self._fork()
+        if pid > 0:
+            return
+        try:
+            # Only the handed-off sockets, the lock and stdio survive into the new process
+            keep = sorted([sock.fileno() for sock in self.sockets.itervalues()] + [self._lockfile])
+            low = 3
+            for fd in keep + [os.sysconf("SC_OPEN_MAX")]:
+                os.closerange(low, fd)
+                low = fd + 1
+            for fd in keep:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+            os.execve(self._exec_argv[0], self._exec_argv + ["start"], env)
+        finally:
+            os._exit(1)
+
+    def _finish_handoff(self):
+        """Tell the process we replaced to drain and exit."""
+        old_pid = os.environ.pop(_HANDOFF_ENV, None)
+        for fd in self._inherited_fds.itervalues():
+            os.close(fd)
+        self._inherited_fds = {}
+        if old_pid:
+            self.logger.info("Graceful restart: taking over from pid %s" % old_pid)
+            self._signal_worker(int(old_pid), signal.SIGTERM)
 
     def _setup_conf_watcher(self):
-        """Use pyinotify to reload the config when it gets changed."""
-        if _USE_PYINOTIFY and os.path.exists(self.config_path):
-            self.logger.info("Starting pyinotify watcher on %s" % self.config_path)
-            wm = pyinotify.WatchManager()
-            notifier = pyinotify.AsyncNotifier(wm, lambda *_: self.handle_update())
-            wm.add_watch(self.config_path, pyinotify.IN_MODIFY)
-            asyncore.loop()
+        """
+        Watch the config file and its drop-in directory from a background
+        thread (pyinotify, or stat polling), and SIGHUP ourselves once per
+        burst of changes so the reload runs through the normal SIGHUP path.
+        """
+        self.logger.info("Watching %s and %s for changes" % (self.config_path, self.config_dir_path))
+        self._conf_watcher = ConfigWatcher([self.config_path, self.config_dir_path],
+                lambda: os.kill(os.getpid(), signal.SIGHUP), debounce=self.autoreload_debounce)
+        self._conf_watcher.start()
 
     def _load_privileges(self):
         """Set user/group from the config, or root/root if none are specified"""
@@ -269,51 +859,205 @@ class Daemon(object):
         
         Only choose one of the logging levels above.
 
-        Logging will also log to syslog by default.
+        Logging will also log to syslog by default. With syslog_transport set
+        to tcp, records go over one persistent, reconnecting TCP connection
+        (RFC 6587 framing) to syslog_host:syslog_port, or a /dev/log stream.
+
+        With async set, the root logger only gets a QueueHandler: callers
+        just enqueue records and a background thread formats and ships them
+        to syslog/stderr in batches. The queue holds queue_size records,
+        overflow picks whether a full queue drops records or blocks.
         """
         logger = logging.getLogger()
-        level_names = {
-            "critical" : logging.CRITICAL,
-            "error"    : logging.ERROR,
-            "warning"  : logging.WARNING,
-            "info"     : logging.INFO,
-            "debug"    : logging.DEBUG
-        }
         level = self.config("logging", "level", "info")
-        logger.setLevel(level_names[level.lower()])
+        logger.setLevel(_LEVEL_NAMES[level.lower()])
         
         log_format = self.config("logging", "format", "%(name)s: %(message)s")
         formatter = logging.Formatter(log_format)
         
         syslog_host = self.config("logging", "syslog_host", "")
-        syslog_port = self.config("logging", "syslog_port", 514)
+        syslog_port = self.config("logging", "syslog_port", 514, transform=int)
         syslog_address = syslog_host and (syslog_host, syslog_port) or "/dev/log"
         syslog_facility = logging.handlers.SysLogHandler.LOG_DAEMON
+        syslog_transport = self.config("logging", "syslog_transport", "udp").lower()
 
-        syslog_handler = logging.handlers.SysLogHandler(syslog_address, syslog_facility)
+        if syslog_transport == "tcp":
+            syslog_handler = TCPSysLogHandler(syslog_address, syslog_facility)
+        else:
+            syslog_handler = logging.handlers.SysLogHandler(syslog_address, syslog_facility)
         syslog_handler.setFormatter(formatter)
-        logger.addHandler(syslog_handler)
         
         stream_handler = logging.StreamHandler()
         stream_handler.setFormatter(formatter)
-        logger.addHandler(stream_handler)
+
+        handlers = [syslog_handler, stream_handler]
+        if self.config("logging", "async", False, transform=to_bool):
+            queue_size = self.config("logging", "queue_size", 10000, transform=int)
+            overflow = self.config("logging", "overflow", QueueHandler.DROP)
+            handlers = [QueueHandler(handlers, queue_size, overflow.lower())]
+        for handler in handlers:
+            logger.addHandler(handler)
         
         self.logger = logging.getLogger(self.name)
 
+    def _flush_logging(self):
+        """Make sure queued log records are shipped before the process exits."""
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
     def _do_run(self):
         """
         Call handle_run, used as a function to support overloading by subclasses
         such as the GeventDaemon.
         """
+        if self._signals is not None and self.signal_dispatch == "thread":
+            self._signals.start()
         self.handle_run()
 
+    # WORKER POOL
+
+    def _worker_count(self):
+        """
+        Number of worker processes to pre-fork, from [daemon] workers.
+        0 (the default) runs handle_run in the daemon process itself, "auto"
+        starts one worker per online CPU.
+        """
+        workers = self.config("daemon", "workers", "0").strip().lower()
+        if workers == "auto":
+            return max(1, os.sysconf("SC_NPROCESSORS_ONLN"))
+        return max(0, int(workers))
+
+    def _run_workers(self, count):
+        """
+        Supervise a pool of forked workers, each running handle_run.
+        The master replaces any worker that dies and fans SIGTERM/SIGINT,
+        SIGHUP, SIGUSR1, SIGUSR2 and the profile signal out to all of them.
+        The master sleeps on its signal queue, woken by SIGCHLD, and reloads
+        its config on SIGHUP from the loop rather than in the handler.
+        """
+        self._workers = {}
+        self._stopping = False
+        self._worker_target = count
+
+        def stop(signum, frame):
+            self._stopping = True
+            self._signal_workers(signal.SIGTERM)
+
+        def update():
+            self.reload_config()
+            self._worker_target = self._worker_count() or self._worker_target
+            self._signal_workers(signal.SIGHUP)
+
+        def forward(signum, frame):
+            self._signal_workers(signum)
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGUSR1, forward)
+        signal.signal(signal.SIGUSR2, forward)
+        signal.signal(self.profile_signal, forward)
+        self._queue_signals({signal.SIGHUP: update})
+        self._signals.register(signal.SIGCHLD, None)
+
+        self.logger.info("Starting %d workers" % count)
+        while True:
+            if not self._stopping:
+                self._scale_workers()
+            elif not self._workers:
+                break
+            self._signals.wait(1.0)
+            self._reap_workers()
+
+    def _reap_workers(self):
+        """Collect every exited worker, pausing before replacing one that died young."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                if ex.args[0] == errno.ECHILD:
+                    self._workers.clear()
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid not in self._workers:
+                continue
+            index, started = self._workers.pop(pid)
+            if self._stopping or index >= self._worker_target:
+                continue
+            self.logger.warning("Worker %d (pid %d) died with status %d, replacing it" %
+                    (index, pid, status))
+            if time.time() - started < self.worker_min_uptime:
+                time.sleep(self.worker_min_uptime)
+
+    def _scale_workers(self):
+        """Start missing workers and stop surplus ones."""
+        used = set(index for index, _ in self._workers.itervalues())
+        for index in range(self._worker_target):
+            if index not in used:
+                self._spawn_worker(index)
+        for pid, (index, _) in self._workers.items():
+            if index >= self._worker_target:
+                self._signal_worker(pid, signal.SIGTERM)
+
+    def _spawn_worker(self, index):
+        """Fork a single worker process with the given index."""
+        pid = self._fork()
+        if pid > 0:
+            self._workers[pid] = (index, time.time())
+            return
+
+        # Worker process: never return into the master's daemonize
+        code = 0
+        try:
+            self.worker_index = index
+            self._workers = {}
+            self._setup_signal_handlers()
+            signal.signal(self.profile_signal, self._timed_handler("profile", self._toggle_profiling))
+            self._do_run()
+        except SystemExit as ex:
+            code = ex.code or 0
+            if not isinstance(code, int):
+                code = 1
+        except Exception as ex:
+            self.logger.error("Worker %d killed by uncaught exception" % index)
+            self.logger.exception(ex)
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _signal_workers(self, signum):
+        """Send a signal to every live worker."""
+        for pid in list(self._workers):
+            self._signal_worker(pid, signum)
+
+    def _signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as ex:
+            if ex.args[0] != errno.ESRCH:
+                raise
+
     # PROCESS CONTROL
 
     def start(self):
-        """Fork and run a new daemon process."""
-        if self.status:
+        """
+        Fork and run a new daemon process.
+        @return Seconds until the daemon reported ready (None in the foreground)
+        """
+        if self.status and not self._is_handoff():
             raise DaemonRunning()
-        self.daemonize()
+        return self.daemonize()
+
+    def _is_handoff(self):
+        """Check whether we are the replacement of the running process."""
+        try:
+            return os.environ.get(_HANDOFF_ENV) == str(self.pid)
+        except DaemonStopped:
+            return False
 
     def foreground(self):
         """Run the process in the foreground."""
@@ -324,22 +1068,19 @@ class Daemon(object):
         """
         Stop the daemon process or kill it if it won't stop.
         @param kill_after Seconds to wait until we kill the process, None means we never kill it
+        Returns as soon as the process has exited.
         """
+        pid = self.pid
         self.signal(signal.SIGTERM)
         
         #All done!
         if kill_after is None:
             return
 
-        #Poll the process status and kill it if it doesn't stop
-        elapsed = 0
-        increment = 0.25
-        while elapsed < kill_after:
-            if self.status is False:
-                return
-            time.sleep(increment)
-            elapsed += increment
-        self.kill()
+        #Wait for the process to exit and kill it if it doesn't stop
+        if not wait_for_exit(pid, kill_after):
+            self.kill()
+            wait_for_exit(pid, 1)
 
     def kill(self):
         """
@@ -350,27 +1091,45 @@ class Daemon(object):
         self.signal(signal.SIGKILL)
 
     def restart(self, kill_after=None):
-        """Restart the process."""
+        """
+        Restart the process, starting the new one as soon as the old one exits.
+        With an invalid config the running process is left alone.
+        """
+        self._check_config()
         if self.status:
             self.stop(kill_after)
-        self.start()
+        return self.start()
+
+    def graceful_restart(self):
+        """
+        Replace the running process without closing its listening sockets,
+        or just start one if none is running.
+        """
+        if self.status:
+            self.signal(self.graceful_restart_signal)
+        else:
+            self.start()
 
     def update(self):
         """Tell the process to update itself."""
+        if os.path.exists(self.control_socket_path):
+            try:
+                self.control("reload")
+                return
+            except (DaemonStopped, ControlError):
+                pass
         self.signal(signal.SIGHUP)
     
     @property
     def status(self):
         """
-        Check if the daemon process is running.
+        Check if the daemon process is running, by whether its lock file is
+        held or else its pid is alive. Stale pidfiles are removed.
         @return True if running
         """
         try:
-            self.signal(0)
+            self.pid
             return True
-        except OSError:
-            self.logger.warning("Pidfile exists but no process is running with pid %s" % self.pid)
-            return False
         except DaemonStopped:
             return False
 
@@ -389,6 +1148,7 @@ class Daemon(object):
     def handle_prerun(self):
         """Prepare for handle_run after fork as a privileged user.
         Example: Open a server socket on a privileged port, then drop to an unprivileged user
+        Sockets opened with self.listen_socket survive graceful restarts.
         """
         pass
 
@@ -403,18 +1163,44 @@ class Daemon(object):
     def handle_update(self):
         """
         Handle an update/sighup.
-        This function is called in an interrupt, watchout for deadlock!
+        Called from the signal dispatcher rather than the signal handler,
+        see _setup_signal_handlers. With the default signal_dispatch of
+        "thread" this runs off the main thread, at the same time as
+        handle_run, so guard any state the two share; set signal_dispatch
+        to "loop" to run it from self.sleep/self.dispatch_signals instead.
         Default action is to call self.reload_config()
         """
         self.logger.info("Reloading config")
-        self.config.update()
+        self.reload_config()
+
+    def reload_config(self):
+        """
+        Re-read the config files, recording how long that took. A config
+        that fails to parse or validate is logged and the running one kept.
+        @return True if any section changed
+        """
+        try:
+            with self.metrics.histogram("daemon_config_reload_seconds", "Seconds spent reloading the config").time():
+                return self.config.update()
+        except ConfigError as ex:
+            self.metrics.counter("daemon_config_rejected_total", "Config reloads rejected as invalid").inc()
+            self.logger.error("Rejected config, keeping the running one: %s" % ex)
+            return False
 
     def handle_usr1(self):
-        """Signal handler for SIGUSR1 signal"""
+        """
+        Signal handler for SIGUSR1 signal.
+        Runs where handle_update does: on the signal dispatch thread,
+        concurrently with handle_run, unless signal_dispatch is "loop".
+        """
         pass
 
     def handle_usr2(self):
-        """Signal handler for SIGUSR2 signal"""
+        """
+        Signal handler for SIGUSR2 signal.
+        Runs where handle_update does: on the signal dispatch thread,
+        concurrently with handle_run, unless signal_dispatch is "loop".
+        """
         pass
 
 def _make_killer(daemon, signum):
@@ -428,10 +1214,16 @@ def make_main(daemon_type, stop_wait_time=8):
     @param stop_wait_time Seconds to wait until killing a process
     """
     def main():
-        daemon = daemon_type()
+        try:
+            daemon = daemon_type()
+        except Exception as ex:
+            _exit_on_error(ex, "-d" in sys.argv[1:] or "--debug" in sys.argv[1:])
+        # Commands beyond status and reload need the control socket
+        commands = daemon._control_enabled() and daemon._commands or {}
         extra_cmds = "".join(map(lambda x: ("|" + x), daemon.signal_alias.values()))
+        extra_cmds += "".join("|" + x for x in sorted(commands) if x not in ("status", "reload"))
 
-        usage = "%prog <start|stop|kill|restart|update|status|foreground" + extra_cmds + ">"
+        usage = "%prog <start|stop|kill|restart|graceful|update|status|foreground" + extra_cmds + ">"
 
         parser = optparse.OptionParser(usage=usage, description=daemon_type.description)
         parser.add_option("-d", "--debug", dest="debug", action="store_true", 
@@ -439,22 +1231,43 @@ def make_main(daemon_type, stop_wait_time=8):
         
         options, args = parser.parse_args()
 
-        if len(args) != 1:
+        if len(args) < 1:
+            parser.error("An action is required")
+        action, action_args = args[0], args[1:]
+        if action_args and action not in commands:
             parser.error("Exactly one argument required")
-        action = args[0]
 
         try:
             def _get_status():
+                if os.path.exists(daemon.control_socket_path):
+                    try:
+                        status = daemon.control("status")
+                        print >>sys.stderr, "Daemon is running (pid %d, up %ds)" % (status["pid"], status["uptime"])
+                        raise SystemExit(0)
+                    except (DaemonStopped, ControlError):
+                        pass
                 if daemon.status:
                     print >>sys.stderr, "Daemon is running"
                     raise SystemExit(0)
                 else:
                     raise DaemonStopped()
 
+            def _command(name):
+                result = daemon.control(name, *action_args)
+                if isinstance(result, (dict, list)):
+                    print json.dumps(result, indent=2, sort_keys=True)
+                elif result is not None:
+                    print result
+
+            def _report_ready(ready_in):
+                if ready_in is not None:
+                    print >>sys.stderr, "Daemon started (ready in %.3fs)" % ready_in
+
             actions = {
-                    "start" : daemon.start,
+                    "start" : lambda: _report_ready(daemon.start()),
                     "stop" : lambda: daemon.stop(stop_wait_time),
-                    "restart" : lambda: daemon.restart(stop_wait_time),
+                    "restart" : lambda: _report_ready(daemon.restart(stop_wait_time)),
+                    "graceful" : daemon.graceful_restart,
                     "update" : daemon.update,
                     "status" : _get_status,
                     "foreground" : daemon.foreground,
@@ -466,6 +1279,9 @@ def make_main(daemon_type, stop_wait_time=8):
                 if action_name:
                     actions[action_name] = _make_killer(daemon, signum)
 
+            for name in commands:
+                actions.setdefault(name, lambda name=name: _command(name))
+
             if action not in actions:
                 parser.error("Unknown action '%s'" % action)
 
@@ -473,27 +1289,26 @@ def make_main(daemon_type, stop_wait_time=8):
             raise SystemExit(0)
         except SystemExit:
             raise
-        except (DaemonStopped, DaemonRunning) as ex:
-            if options.debug:
-                traceback.print_exc()
-            else:
-                print >>sys.stderr, ex
-            raise SystemExit(1)
-        except (IOError, OSError) as ex:
-            if options.debug:
-                traceback.print_exc()
-            else:
-                print >>sys.stderr, "%s: %s" % (ex.__class__.__name__, ex)
-            print >>sys.stderr, "Are you running as root?"
-            raise SystemExit(2)
         except Exception as ex:
-            if options.debug:
-                traceback.print_exc()
-            else:
-                print >>sys.stderr, "%s: %s" % (ex.__class__.__name__, ex)
-            raise SystemExit(3)
+            _exit_on_error(ex, options.debug)
     return main
 
+def _exit_on_error(ex, debug):
+    """Report an exception raised by a make_main action and exit accordingly."""
+    expected = isinstance(ex, (DaemonStopped, DaemonRunning, DaemonStartFailed, ControlError, ConfigError))
+    if debug:
+        traceback.print_exc()
+    elif expected:
+        print >>sys.stderr, ex
+    else:
+        print >>sys.stderr, "%s: %s" % (ex.__class__.__name__, ex)
+    if expected:
+        raise SystemExit(1)
+    if isinstance(ex, (IOError, OSError)):
+        print >>sys.stderr, "Are you running as root?"
+        raise SystemExit(2)
+    raise SystemExit(3)
+
 if _USE_GEVENT:
     class GeventDaemon(Daemon):
         """
@@ -501,6 +1316,7 @@ if _USE_GEVENT:
         """
         def _fork(self):
             """Override Daemon._fork with gevent's fork."""
+            import gevent
             return gevent.fork()
 
         def _setup_signal_handlers(self):
@@ -508,13 +1324,15 @@ if _USE_GEVENT:
             Set up signal handlers with gevent instead of with python's 
             signal module.
             """
-            gevent.signal(signal.SIGTERM, lambda *_: self.handle_stop())
-            gevent.signal(signal.SIGHUP, lambda *_: self.handle_update())
-            gevent.signal(signal.SIGUSR1, lambda *_: self.handle_usr1())
-            gevent.signal(signal.SIGUSR2, lambda *_: self.handle_usr2())
+            import gevent
+            gevent.signal(signal.SIGTERM, self._timed_handler("SIGTERM", self.handle_stop))
+            gevent.signal(signal.SIGHUP, self._timed_handler("SIGHUP", self.handle_update))
+            gevent.signal(signal.SIGUSR1, self._timed_handler("SIGUSR1", self.handle_usr1))
+            gevent.signal(signal.SIGUSR2, self._timed_handler("SIGUSR2", self.handle_usr2))
         
         def _do_run(self):
             """Override Daemon._do_run so we can join on greenlets."""
+            import gevent
             main = gevent.spawn(self.handle_run)
             while True:
                 try:
@@ -522,3 +1340,386 @@ if _USE_GEVENT:
                     break
                 except KeyboardInterrupt:
                     self.handle_stop()
+
+if _USE_ASYNCIO:
+    def _import_asyncio():
+        """asyncio, or trollius where the standard library lacks it."""
+        try:
+            import asyncio
+        except ImportError:
+            import trollius as asyncio
+        return asyncio
+
+    def _ensure_future(coro_or_future, loop):
+        asyncio = _import_asyncio()
+        ensure_future = getattr(asyncio, "ensure_future", None) or getattr(asyncio, "async")
+        return ensure_future(coro_or_future, loop=loop)
+
+    def _all_tasks(loop):
+        asyncio = _import_asyncio()
+        if hasattr(asyncio, "all_tasks"):
+            return asyncio.all_tasks(loop)
+        return asyncio.Task.all_tasks(loop)
+
+    class AsyncioDaemon(Daemon):
+        """
+        Daemon to use when you need to utilize asyncio within the daemon.
+
+        handle_run may return a coroutine, which runs as the main task of
+        self.loop; otherwise the loop runs until the daemon is stopped.
+        Signals are installed with loop.add_signal_handler. On stop every
+        in-flight task is cancelled and given [daemon] stop_timeout seconds
+        (default 5) to finish. uvloop is used when installed, unless
+        use_uvloop is False.
+
+        The loop is created after handle_prerun (and after forking workers),
+        so sockets bound in handle_prerun should be handed to the loop in
+        handle_run, e.g. with loop.create_server(sock=...).
+        """
+        use_uvloop = True
+        stop_timeout = 5
+
+        _loop = None
+
+        @property
+        def loop(self):
+            """The daemon's event loop, created on first use."""
+            if self._loop is None:
+                self._loop = self._new_loop()
+                _import_asyncio().set_event_loop(self._loop)
+            return self._loop
+
+        def _new_loop(self):
+            if self.use_uvloop:
+                try:
+                    import uvloop
+                    return uvloop.new_event_loop()
+                except ImportError:
+                    pass
+            return _import_asyncio().new_event_loop()
+
+        def _setup_signal_handlers(self):
+            """
+            Set up signal handlers with the event loop instead of with
+            python's signal module. A worker pool master keeps plain
+            handlers and never creates the loop, so each forked worker
+            makes its own rather than sharing one epoll instance.
+            """
+            if self.worker_index is None and self._worker_count():
+                return Daemon._setup_signal_handlers(self)
+            if self._signals is not None:
+                # Inherited from the master
+                self._signals.close()
+                self._signals = None
+            self.loop.add_signal_handler(signal.SIGINT, self._timed_handler("SIGINT", self.handle_stop))
+            self.loop.add_signal_handler(signal.SIGTERM, self._timed_handler("SIGTERM", self.handle_stop))
+            self.loop.add_signal_handler(signal.SIGHUP, self._timed_handler("SIGHUP", self.handle_update))
+            self.loop.add_signal_handler(signal.SIGUSR1, self._timed_handler("SIGUSR1", self.handle_usr1))
+            self.loop.add_signal_handler(signal.SIGUSR2, self._timed_handler("SIGUSR2", self.handle_usr2))
+
+        def _do_run(self):
+            """Override Daemon._do_run to run handle_run on the event loop."""
+            self._stopping = False
+            self._main = None
+            asyncio = _import_asyncio()
+            result = self.handle_run()
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                self._main = _ensure_future(result, loop=self.loop)
+                self._main.add_done_callback(lambda _: self.handle_stop())
+            try:
+                self.loop.run_forever()
+                if self._main is not None and not self._main.cancelled():
+                    self._main.result()
+            finally:
+                self.loop.close()
+
+        def handle_stop(self):
+            """Cancel in-flight tasks and stop the loop once they have drained."""
+            if self._stopping:
+                return
+            self._stopping = True
+            tasks = [task for task in _all_tasks(self.loop) if not task.done()]
+            if not tasks:
+                self.loop.stop()
+                return
+            for task in tasks:
+                task.cancel()
+            timeout = self.config("daemon", "stop_timeout", self.stop_timeout, transform=to_duration)
+            waiter = _ensure_future(_import_asyncio().wait(tasks, timeout=timeout), loop=self.loop)
+            waiter.add_done_callback(self._drained)
+
+        def _drained(self, waiter):
+            done, pending = waiter.result()
+            if pending:
+                self.logger.warning("%d tasks still running after stop_timeout" % len(pending))
+            self.loop.stop()
+
+import unittest, shutil
+from daemonhelper.config import ConfigSchema
+
+def make_test_daemon(daemon_type, directory, config=""):
+    """
+    Build daemon_type with its config and data paths under directory,
+    running as the invoking user. It logs to neither syslog nor stderr,
+    only to handlers the test adds.
+    """
+    for path in ["etc", "var/run", "var/lib", "var/lock"]:
+        if not os.path.isdir(os.path.join(directory, path)):
+            os.makedirs(os.path.join(directory, path))
+    with open(os.path.join(directory, "etc", "%s.conf" % daemon_type.name), "w") as fd:
+        fd.write("[daemon]\nuser: %s\ngroup: %s\n" % (pwd.getpwuid(os.getuid()).pw_name,
+                grp.getgrgid(os.getgid()).gr_name))
+        # A syslog host spares the need for /dev/log
+        fd.write("[logging]\nsyslog_host: 127.0.0.1\n" + config)
+    test_type = type(daemon_type.__name__, (daemon_type,), {
+        "SYSTEM_CONFIG_BASE" : os.path.join(directory, "etc"),
+        "SYSTEM_DATA_BASE"   : os.path.join(directory, "var"),
+    })
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    daemon = test_type()
+    for handler in root.handlers[:]:
+        if handler not in handlers:
+            root.removeHandler(handler)
+            handler.close()
+    daemon.logger.addHandler(logging.NullHandler())
+    if not os.path.isdir(daemon.pidfile_dir):
+        os.mkdir(daemon.pidfile_dir)
+    return daemon
+
+class TestDaemon(unittest.TestCase):
+    class Sleeper(Daemon):
+        name = "test_daemon"
+        config_schema = ConfigSchema({"sleeper": {"interval": ("duration", 1)}})
+
+        def handle_run(self):
+            while True:
+                time.sleep(1)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.daemon = make_test_daemon(self.Sleeper, self.directory)
+        self.children = []
+
+    def tearDown(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        shutil.rmtree(self.directory)
+
+    def _fork_running(self):
+        """Fork a process that holds the daemon's pidfile until killed."""
+        ready = ReadinessPipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ready.close_read()
+                self.daemon._write_pidfile()
+                ready.ready()
+                while True:
+                    time.sleep(1)
+            finally:
+                os._exit(0)
+        self.children.append(pid)
+        ready.close_write()
+        self.assertEquals((True, None), ready.wait(5))
+        return pid
+
+    def test_restart_invalid_config(self):
+        pid = self._fork_running()
+        daemon = make_test_daemon(self.Sleeper, self.directory, "[sleeper]\ninterval: soon\n")
+        self.assertRaises(DaemonStartFailed, daemon.restart, 1)
+        self.assertEquals(pid, daemon.pid)
+        self.assertEquals((0, 0), os.waitpid(pid, os.WNOHANG))
+
+    def _dead_pid(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def _write_pid(self, pid):
+        with open(self.daemon.pidfile_path, "w") as fd:
+            fd.write(str(pid))
+
+    def test_lock_probe(self):
+        pid = self._fork_running()
+        self.assertEquals(pid, self.daemon.pid)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self.assertEquals(False, self.daemon.status)
+        self.assertEquals(False, os.path.exists(self.daemon.pidfile_path))
+
+    def test_second_start(self):
+        pid = self._fork_running()
+        self.assertRaises(DaemonRunning, self.daemon._write_pidfile)
+        self.assertEquals(pid, self.daemon.pid)
+
+    def test_unlocked_pidfile(self):
+        # As written by a daemon started before the lock file existed
+        self._write_pid(os.getpid())
+        self.assertEquals(os.getpid(), self.daemon.pid)
+        self._write_pid(self._dead_pid())
+        self.assertEquals(False, self.daemon.status)
+        self.assertEquals(False, os.path.exists(self.daemon.pidfile_path))
+
+    def test_replaced_under_probe(self):
+        self._write_pid(self._dead_pid())
+        remove_stale = self.daemon._remove_stale_pidfile
+        started = []
+        def start_first(fd):
+            if not started:
+                started.append(self._fork_running())
+            return remove_stale(fd)
+        self.daemon._remove_stale_pidfile = start_first
+        pid = self.daemon.pid
+        self.assertEquals([pid], started)
+        self.assertEquals(True, os.path.exists(self.daemon.pidfile_path))
+
+class TestWorkerPool(unittest.TestCase):
+    class Worker(Daemon):
+        name = "test_workers"
+        worker_min_uptime = 0
+
+        def handle_run(self):
+            path = os.path.join(self.SYSTEM_DATA_BASE, "worker-%d" % self.worker_index)
+            with open(path + ".tmp", "w") as fd:
+                fd.write(str(os.getpid()))
+            os.rename(path + ".tmp", path)
+            while True:
+                time.sleep(1)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.daemon = make_test_daemon(self.Worker, self.directory, "[daemon]\nworkers: 2\n")
+        self.master = os.fork()
+        if self.master == 0:
+            code = 1
+            try:
+                os.setpgid(0, 0)
+                self.daemon.foreground()
+                code = 0
+            finally:
+                os._exit(code)
+        # A group of its own, so the master and its workers are killed at once
+        os.setpgid(self.master, self.master)
+        self.addCleanup(self._kill_pool, self.master)
+        self._wait(lambda: len(self._workers()) == 2)
+
+    def _kill_pool(self, group):
+        try:
+            os.killpg(group, signal.SIGKILL)
+        except OSError as ex:
+            if ex.args[0] != errno.ESRCH:
+                raise
+        if self.master is not None:
+            os.waitpid(self.master, 0)
+        shutil.rmtree(self.directory)
+
+    def _workers(self):
+        """{worker index: pid} of the workers started last."""
+        workers = {}
+        for index in range(2):
+            try:
+                workers[index] = int(open(os.path.join(self.directory, "var", "worker-%d" % index)).read())
+            except IOError:
+                pass
+        return workers
+
+    def _wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assert_(time.time() < deadline)
+            time.sleep(0.02)
+
+    def test_respawn(self):
+        workers = self._workers()
+        os.kill(workers[0], signal.SIGKILL)
+        self._wait(lambda: self._workers()[0] != workers[0])
+        self.assertEquals(workers[1], self._workers()[1])
+        self._wait(lambda: not process_exists(workers[0]))
+        self.assertEquals((0, 0), os.waitpid(self.master, os.WNOHANG))
+
+    def test_stop(self):
+        workers = self._workers()
+        self.assertEquals(self.master, self.daemon.pid)
+        self.daemon.stop(5)
+        _, status = os.waitpid(self.master, 0)
+        self.master = None
+        self.assertEquals(True, os.WIFEXITED(status))
+        self.assertEquals(0, os.WEXITSTATUS(status))
+        for pid in workers.values():
+            self.assertEquals(False, process_exists(pid))
+        self.assertEquals(False, self.daemon.status)
+
+if _USE_ASYNCIO:
+    _coroutine = _import_asyncio().coroutine
+
+    class TestAsyncioDaemon(unittest.TestCase):
+        class Server(AsyncioDaemon):
+            name = "test_asyncio"
+            use_uvloop = False
+            # Seconds a cancelled worker takes to clean up
+            cleanup = 0.1
+
+            def handle_run(self):
+                self.cancelled = []
+                return self._serve()
+
+            @_coroutine
+            def _serve(self):
+                asyncio = _import_asyncio()
+                self.loop.call_later(0.1, self.handle_stop)
+                _ensure_future(self._worker(), loop=self.loop)
+                try:
+                    yield asyncio.sleep(60)
+                except asyncio.CancelledError:
+                    self.cancelled.append("main")
+                    raise
+
+            @_coroutine
+            def _worker(self):
+                asyncio = _import_asyncio()
+                try:
+                    yield asyncio.sleep(60)
+                except asyncio.CancelledError as ex:
+                    yield asyncio.sleep(self.cleanup)
+                    self.cancelled.append("worker")
+                    raise ex
+
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+
+        def tearDown(self):
+            _import_asyncio().set_event_loop(None)
+            shutil.rmtree(self.directory)
+
+        def _run(self, config="", cleanup=0.1):
+            """Run the daemon until it stops, returning it, the seconds taken and its log."""
+            daemon = make_test_daemon(self.Server, self.directory, config)
+            daemon.cleanup = cleanup
+            messages = []
+            handler = logging.Handler()
+            handler.emit = lambda record: messages.append(record.getMessage())
+            daemon.logger.addHandler(handler)
+            started = time.time()
+            daemon._do_run()
+            return daemon, time.time() - started, messages
+
+        def test_cancel(self):
+            daemon, elapsed, messages = self._run()
+            self.assertEquals(["main", "worker"], sorted(daemon.cancelled))
+            # Stops once the tasks drain, not after stop_timeout
+            self.assert_(elapsed < 1)
+            self.assertEquals([], messages)
+
+        def test_stop_timeout(self):
+            daemon, elapsed, messages = self._run("[daemon]\nstop_timeout: 300ms\n", cleanup=5)
+            self.assertEquals(["main"], daemon.cancelled)
+            self.assert_(0.4 <= elapsed < 2)
+            self.assertEquals(["1 tasks still running after stop_timeout"], messages)
+            self.assertEquals(True, daemon.loop.is_closed())
@@ -1,4 +1,26 @@
-from ConfigParser import NoSectionError, NoOptionError, SafeConfigParser as ConfigParser
+import os
+import re
+import time
+import errno
+import hashlib
+import threading
+from cStringIO import StringIO
+from ConfigParser import Error as ParserError, RawConfigParser, SafeConfigParser as ConfigParser
+
+from daemonhelper.exceptions import ConfigError
+
+# Files modified this recently may change again without their mtime moving
+# (timestamps are only as fine as the filesystem clock), so their stat
+# signature is not trusted to skip the next update.
+_RACY_WINDOW = 2.0
+
+# Shared by every Option and Section until its first callback is added, so
+# the common case of no callbacks costs no list per object.
+_NO_CALLBACKS = ()
+
+def _intern(name):
+    """Share one copy of each section and option name."""
+    return intern(name) if type(name) is str else name
 
 def run_all(methods, *args):
     for method in methods:
@@ -7,23 +29,171 @@ def run_all(methods, *args):
 def ignore():
     pass
 
+def to_bool(value):
+    """Transform for yes/no style options."""
+    value = value.strip().lower()
+    if value in ("1", "yes", "true", "on"):
+        return True
+    if value in ("0", "no", "false", "off", ""):
+        return False
+    raise ValueError("Not a boolean: %r" % value)
+
+def to_octal(value):
+    """Transform for octal options such as umasks."""
+    return int(value, 8)
+
+_DURATION = re.compile(r"^\s*([0-9]*\.?[0-9]+)\s*(ms|s|m|h|d)?\s*$")
+_DURATION_UNITS = {None: 1, "ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def to_duration(value):
+    """Transform for durations like 250ms, 30, 30s, 5m, 2h or 1d, in seconds."""
+    match = _DURATION.match(value.lower())
+    if match is None:
+        raise ValueError("Not a duration: %r" % value)
+    number, unit = match.groups()
+    return float(number) * _DURATION_UNITS[unit]
+
+def to_list(value):
+    """Transform for comma separated lists."""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+TYPES = {
+    "str"      : str,
+    "int"      : int,
+    "float"    : float,
+    "bool"     : to_bool,
+    "octal"    : to_octal,
+    "duration" : to_duration,
+    "list"     : to_list,
+}
+
+def _stat_signature(path):
+    """(mtime, size, inode) of a file, or None if it can't be stat'ed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+def _read_file(path):
+    """Contents of a file, or an empty string if it does not exist."""
+    try:
+        with open(path) as fd:
+            return fd.read()
+    except IOError as ex:
+        if ex.args[0] == errno.ENOENT:
+            return ""
+        raise
+
+def _list_overlays(directory):
+    """Sorted *.conf drop-in files of an overlay directory."""
+    if directory is None:
+        return []
+    try:
+        names = os.listdir(directory)
+    except OSError as ex:
+        if ex.args[0] in (errno.ENOENT, errno.ENOTDIR):
+            return []
+        raise
+    return [os.path.join(directory, name) for name in sorted(names)
+            if name.endswith(".conf") and not name.startswith(".")]
+
+class _LayerParser(ConfigParser):
+    def section_items(self, name):
+        """The options set in this file's section, without [DEFAULT]s."""
+        return [(key, value) for key, value in self._sections[name].iteritems() if key != "__name__"]
+
+class _Layer(object):
+    """
+    The parsed contents of one config file, reused for as long as the file's
+    stat signature or content hash says it is unchanged.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        self.digest = None
+        self.parser = None
+
+    def refresh(self, force=False):
+        """
+        Re-parse the file if it changed.
+        @return True if the file was parsed
+        """
+        signature = _stat_signature(self.path)
+        if not force and signature is not None and signature == self.signature:
+            return False
+        text = _read_file(self.path)
+        digest = hashlib.sha1(text).digest()
+        if not force and digest == self.digest:
+            self._remember_signature(signature)
+            return False
+
+        parser = _LayerParser()
+        parser.readfp(StringIO(text), self.path)
+        self.parser = parser
+        self.digest = digest
+        self._remember_signature(signature)
+        return True
+
+    def _remember_signature(self, signature):
+        if signature is not None and time.time() - signature[0] > _RACY_WINDOW:
+            self.signature = signature
+        else:
+            self.signature = None
+
+class ConfigSnapshot(object):
+    """
+    Immutable, fully parsed config: the merged and interpolated values of
+    every section. ConfigFile builds a new snapshot on each reload and
+    swaps it in whole, so a reader holding one sees a consistent config
+    however reloads interleave with it.
+    """
+    __slots__ = ("_sections",)
+
+    def __init__(self, sections):
+        self._sections = sections
+
+    @classmethod
+    def from_parser(cls, parser):
+        return cls(dict((_intern(name), dict((_intern(key), value) for key, value in parser.items(name)))
+                for name in parser.sections()))
+
+    def sections(self):
+        return self._sections.keys()
+
+    def values(self, section):
+        """{option: raw value} of a section, or None. Don't modify it."""
+        return self._sections.get(section)
+
+    def raw(self, section, option):
+        values = self._sections.get(section)
+        if values is None:
+            return None
+        return values.get(option)
+
+    def get(self, section, option, default=None, transform=str):
+        value = self.raw(section, option)
+        if value is None:
+            return default
+        return transform(value)
+
 class Option(object):
+    __slots__ = ("name", "_value", "_in_config_file", "_on_update")
+
     def __init__(self, name):
-        self.name = name
+        self.name = _intern(name)
         self._value = None
         self._in_config_file = False
-        self._on_update = []
+        self._on_update = _NO_CALLBACKS
 
-    def update(self, parser, section_name):
-        try:
-            current_value = parser.get(section_name, self.name)
-            self._in_config_file = True
-            self.set(current_value)
-        except (NoSectionError, NoOptionError):
-            self._in_config_file = False
-            self.set(None)
+    def update(self, snapshot, section_name):
+        current_value = snapshot.raw(section_name, self.name)
+        self._in_config_file = current_value is not None
+        self.set(current_value)
 
     def on_update(self, cb, eb=ignore, default=None, transform=str):
+        if self._on_update is _NO_CALLBACKS:
+            self._on_update = []
         self._on_update.append((cb, eb, default, transform))
 
     def set(self, value):
@@ -53,30 +223,103 @@ class Option(object):
     def __repr__(self):
         return "<Option %s>" % self.name
 
+class Setting(object):
+    """
+    Typed, cached view of one Option. The transformed value is kept in
+    self.value and only recomputed when Option.set sees a new raw value, so
+    reading it is a single attribute load. If a new raw value fails to
+    transform, the last good value is kept and the error is put in
+    self.error.
+    """
+    def __init__(self, option, transform=str, default=None):
+        self.option = option
+        self.transform = transform
+        self.default = default
+        self.error = None
+        try:
+            self.value = option.get(default, transform)
+        except Exception as ex:
+            self.value = default
+            self.error = ex
+        option.on_update(self._set, self._fail, default, transform)
+
+    def _set(self, value):
+        self.value = value
+        self.error = None
+
+    def _fail(self, error):
+        self.error = error
+
+    def __repr__(self):
+        return "<Setting %s=%r>" % (self.option.name, self.value)
+
+class Settings(object):
+    """Attribute namespace of compiled Settings, one per section."""
+    def __init__(self, items):
+        self.__dict__.update(items)
+
+class ConfigSchema(object):
+    """
+    Declarative description of typed options, compiled against a ConfigFile
+    into Setting objects:
+
+    schema = ConfigSchema({
+        "mydaemon": {
+            "interval" : ("duration", 2),
+            "hosts"    : ("list", []),
+        },
+    })
+    settings = schema.compile(config)
+    interval = settings.mydaemon.interval
+    interval.value
+
+    Types are names from TYPES or any transform callable.
+    """
+    def __init__(self, sections):
+        self.sections = {}
+        for section, options in sections.iteritems():
+            compiled = self.sections[section] = {}
+            for option, (type_, default) in options.iteritems():
+                transform = TYPES[type_] if isinstance(type_, basestring) else type_
+                compiled[option] = (transform, default)
+
+    def compile(self, config):
+        return Settings((section, Settings((option, config.setting(section, option, transform, default))
+                for option, (transform, default) in options.iteritems()))
+            for section, options in self.sections.iteritems())
+
+    def validate(self, snapshot):
+        """ConfigFile validator rejecting configs where an option fails its transform."""
+        for section, options in self.sections.iteritems():
+            for option, (transform, default) in options.iteritems():
+                try:
+                    snapshot.get(section, option, default, transform)
+                except Exception as ex:
+                    raise ConfigError("[%s] %s: %s" % (section, option, ex))
+
 class Section(object):
+    __slots__ = ("name", "_options", "_in_config_file", "_on_add", "_on_remove")
+
     option_factory = Option
 
     def __init__(self, name):
-        self.name = name
+        self.name = _intern(name)
         self._options = {}
         self._in_config_file = False
-        self._on_add = []
-        self._on_remove = []
+        self._on_add = _NO_CALLBACKS
+        self._on_remove = _NO_CALLBACKS
 
-    def update(self, parser):
+    def update(self, snapshot):
         #Get list of options in file before update
         options_in_file_before = set(self._iter_options_in_file())
         
         #Get list of options in file after update
         options_in_file_after = set()
-        try:
-            names = parser.options(self.name)
-            self._in_config_file = True
-            for name in names:
-                option = self[name]
-                options_in_file_after.add(option)
-        except NoSectionError:
-            self._in_config_file = False
+        values = snapshot.values(self.name)
+        self._in_config_file = values is not None
+        for name in values or ():
+            option = self[name]
+            options_in_file_after.add(option)
 
         #Compare sets to figure out which options added/removed from file
         for option in options_in_file_after - options_in_file_before:
@@ -87,7 +330,7 @@ class Section(object):
 
         #Look for updates in all option values
         for option in self:
-            option.update(parser, self.name)
+            option.update(snapshot, self.name)
         
 
     def _iter_options_in_file(self):
@@ -103,13 +346,21 @@ class Section(object):
             self._options[name] = option
             return option
 
+    def get(self, name):
+        """The option if it is known, without creating it."""
+        return self._options.get(name)
+
     def __iter__(self):
         return self._options.itervalues()
 
     def on_add(self, cb):
+        if self._on_add is _NO_CALLBACKS:
+            self._on_add = []
         self._on_add.append(cb)
 
     def on_remove(self, cb):
+        if self._on_remove is _NO_CALLBACKS:
+            self._on_remove = []
         self._on_remove.append(cb)
 
     @property
@@ -123,32 +374,121 @@ class Section(object):
         return "<Section %s>" % self.name
 
 class ConfigFile(object):
+    """
+    A config file and its overlays. Reads go through the live
+    ConfigSnapshot without locking; update() builds and validates a new
+    snapshot off to the side and only then swaps it in, so a reader on
+    another thread never sees a half-applied reload. Each validator is
+    called with the new snapshot and rejects it by raising ConfigError or
+    ValueError.
+
+    An invalid config on disk never raises from the constructor: whatever
+    of it parsed becomes the first snapshot, so paths and the CLI still
+    work against a running daemon, and the error is kept in self.error
+    for whoever must refuse it, such as Daemon.start.
+    """
     section_factory = Section
 
-    def __init__(self, path):
+    def __init__(self, path, overlay_dir=None, validators=()):
         self.path = path
+        self.overlay_dir = overlay_dir
+        self.validators = list(validators)
         self._sections = {}
         self._on_add = []
         self._on_remove = []
-        self.update()
+        self._layers = {}
+        self._stale = False
+        self._loaded = False
+        self._update_lock = threading.Lock()
+        self._snapshot = ConfigSnapshot({})
+        self.error = None
+        try:
+            self.update()
+        except ConfigError:
+            pass
+
+    @property
+    def snapshot(self):
+        """The live ConfigSnapshot, to read several options from one config."""
+        return self._snapshot
+
+    @property
+    def paths(self):
+        """The main file followed by its overlays, in merge order."""
+        return [self.path] + _list_overlays(self.overlay_dir)
+
+    def update(self, force=False):
+        """
+        Re-read the config, swap in the new snapshot and then fire
+        callbacks for whatever changed.
+
+        The main file is merged with every *.conf file in overlay_dir, in
+        name order, later files overriding earlier ones. Each file is only
+        re-parsed if its (mtime, size, inode) and content hash changed, and
+        only sections whose merged options changed are diffed. force skips
+        both checks.
+        @return True if anything was parsed
+        @raise ConfigError if the config can't be parsed or fails validation;
+        the live snapshot is left as it was, and the error kept in self.error
+        """
+        with self._update_lock:
+            snapshot = None
+            try:
+                snapshot = self._load(force or self._stale)
+                if snapshot is not None:
+                    for validator in self.validators:
+                        validator(snapshot)
+            except (ParserError, ConfigError, ValueError, EnvironmentError) as ex:
+                # Layers that did parse are cached, so merge them all next time
+                self._stale = True
+                self.error = isinstance(ex, ConfigError) and ex or ConfigError(str(ex))
+                if snapshot is not None and not self._loaded:
+                    self._publish(snapshot, force)
+                raise self.error
+            self._stale = False
+            self.error = None
+            if snapshot is None:
+                return False
+            self._loaded = True
+            self._publish(snapshot, force)
+            return True
+
+    def _load(self, force):
+        """Parse a new snapshot, or None if no file changed."""
+        paths = self.paths
+        changed = force or len(paths) != len(self._layers)
+        layers = []
+        for path in paths:
+            layer = self._layers.get(path)
+            if layer is None:
+                layer = self._layers[path] = _Layer(path)
+                changed = True
+            if layer.refresh(force):
+                changed = True
+            layers.append(layer)
+        for path in set(self._layers) - set(paths):
+            del self._layers[path]
+        if not changed:
+            return None
+
+        if len(layers) == 1:
+            parser = layers[0].parser
+        else:
+            parser = self._merge(layers)
+        return ConfigSnapshot.from_parser(parser)
 
-    def update(self):
-        parser = ConfigParser()
-        parser.read(self.path)
+    def _publish(self, snapshot, force=False):
+        """Make snapshot the live config, then fire callbacks for what changed."""
+        previous, self._snapshot = self._snapshot, snapshot
 
         #Get list of sections in file before update
         sections_in_file_before = set(self._iter_sections_in_file())
         
         #Get list of sections in file after update
         sections_in_file_after = set()
-        try:
-            names = parser.sections()
-            self._in_config_file = True
-            for name in names:
-                section = self[name]
-                sections_in_file_after.add(section)
-        except NoSectionError:
-            self._in_config_file = False
+        for name in snapshot.sections():
+            section = self[name]
+            sections_in_file_after.add(section)
         
         #Compare sets to figure out which sections added/removed from file
         for section in sections_in_file_after - sections_in_file_before:
@@ -157,9 +497,23 @@ class ConfigFile(object):
         for section in sections_in_file_before - sections_in_file_after:
             run_all(self._on_remove, section)
 
-        #Look for updates in all section values
+        #Look for updates in sections whose options changed
         for section in self:
-            section.update(parser)
+            if force or snapshot.values(section.name) != previous.values(section.name):
+                section.update(snapshot)
+
+    def _merge(self, layers):
+        """Overlay the cached parsers of each file into a single parser."""
+        merged = ConfigParser()
+        for layer in layers:
+            for key, value in layer.parser.defaults().iteritems():
+                RawConfigParser.set(merged, "DEFAULT", key, value)
+            for name in layer.parser.sections():
+                if not merged.has_section(name):
+                    merged.add_section(name)
+                for key, value in layer.parser.section_items(name):
+                    RawConfigParser.set(merged, name, key, value)
+        return merged
 
     def _iter_sections_in_file(self):
         for section in self:
@@ -183,11 +537,24 @@ class ConfigFile(object):
     def on_remove(self, cb):
         self._on_remove.append(cb)
 
+    def setting(self, section, option, transform=str, default=None):
+        """
+        Bind a typed Setting to an option. transform may be a TYPES name.
+        """
+        if isinstance(transform, basestring):
+            transform = TYPES[transform]
+        return Setting(self[section][option], transform, default)
+
+    def get(self, name):
+        """The section if it is known, without creating it."""
+        return self._sections.get(name)
+
     def __call__(self, section, option, default=None, transform=str, update_cb=None, update_eb=ignore):
-        option = self[section][option]
         if update_cb is not None:
-            option.on_update(update_cb, update_eb, default, transform)
-        return option.get(default, transform) 
+            self[section][option].on_update(update_cb, update_eb, default, transform)
+        # Lookups only read the live snapshot, so a missing option returns
+        # the default without creating it
+        return self._snapshot.get(section, option, default, transform)
 
 import unittest, tempfile, os
 
@@ -303,6 +670,149 @@ e: hello
 
         self.assertEquals('foo', self._test_section_remove_name)
 
+    def test_overlays(self):
+        self._write_config(self.example_config1)
+        overlay_dir = tempfile.mkdtemp()
+        def write_overlay(name, text):
+            with open(os.path.join(overlay_dir, name), "w") as fd:
+                fd.write(text)
+        write_overlay("10-first.conf", "[foo]\na: 10\n")
+        write_overlay("20-second.conf", "[foo]\na: 20\n[qux]\nf: 1\n")
+        write_overlay("ignored.txt", "[foo]\na: 30\n")
+        try:
+            config = ConfigFile(self.cfgpath, overlay_dir)
+            self.assertEquals(20, config('foo', 'a', transform=int))
+            self.assertEquals('bar', config('foo', 'b'))
+            self.assertEquals(1, config('qux', 'f', transform=int))
+
+            updates = []
+            config('foo', 'a', update_cb=updates.append)
+            main_parser = config._layers[self.cfgpath].parser
+            os.unlink(os.path.join(overlay_dir, "20-second.conf"))
+            self.assertEquals(True, config.update())
+            self.assertEquals(['10'], updates)
+            self.assertEquals(False, config['qux'].in_config_file)
+            self.assert_(main_parser is config._layers[self.cfgpath].parser)
+        finally:
+            for name in os.listdir(overlay_dir):
+                os.unlink(os.path.join(overlay_dir, name))
+            os.rmdir(overlay_dir)
+
+    def test_setting(self):
+        self._write_config(self.example_config1)
+        config = ConfigFile(self.cfgpath)
+
+        settings = ConfigSchema({
+            'foo' : {'a' : ('int', 2), 'b' : ('list', [])},
+            'bar' : {'d' : ('int', 0), 'e' : ('duration', 30)},
+        }).compile(config)
+        self.assertEquals(1, settings.foo.a.value)
+        self.assertEquals(['bar'], settings.foo.b.value)
+        self.assertEquals(9, settings.bar.d.value)
+        self.assertEquals(30, settings.bar.e.value)
+
+        self._write_config(self.example_config2)
+        config.update()
+        self.assertEquals(2, settings.foo.a.value)
+        self.assertEquals(9, settings.bar.d.value)
+        self.assert_(isinstance(settings.bar.d.error, ValueError))
+
+    def test_transforms(self):
+        self.assertEquals(0.25, to_duration("250ms"))
+        self.assertEquals(300, to_duration("5m"))
+        self.assertEquals(7, to_duration("7"))
+        self.assertEquals(0007, to_octal("007"))
+        self.assertEquals(True, to_bool("Yes"))
+        self.assertEquals(["a", "b"], to_list("a, b,"))
+        self.assertRaises(ValueError, to_duration, "soon")
+
+    def test_update_unchanged(self):
+        self._write_config(self.example_config1)
+        config = ConfigFile(self.cfgpath)
+
+        updates = []
+        config('foo', 'a', update_cb=updates.append)
+        os.utime(self.cfgpath, (1, 1))
+        self.assertEquals(False, config.update())
+        self.assertNotEquals(None, config._layers[self.cfgpath].signature)
+        self.assertEquals(False, config.update())
+
+        self._write_config(self.example_config1)
+        self.assertEquals(False, config.update())
+        self.assertEquals([], updates)
+
+    def test_update_changed_section(self):
+        self._write_config(self.example_config1)
+        config = ConfigFile(self.cfgpath)
+
+        parsed = []
+        original_update = Section.update
+        def update(section, parser):
+            parsed.append(section.name)
+            original_update(section, parser)
+        Section.update = update
+        try:
+            self._write_config(self.example_config1.replace("c: 14", "c: 15"))
+            self.assertEquals(True, config.update())
+        finally:
+            Section.update = original_update
+        self.assertEquals(['bar'], parsed)
+        self.assertEquals(15, config('bar', 'c', transform=int))
+
+    def test_missing_lookup(self):
+        self._write_config(self.example_config1)
+        config = ConfigFile(self.cfgpath)
+
+        self.assertEquals(5, config('foo', 'missing', default=5))
+        self.assertEquals(5, config('nosection', 'missing', default=5))
+        self.assertEquals(None, config['foo'].get('missing'))
+        self.assertEquals(None, config.get('nosection'))
+        self.assert_(config['foo']['a'] is config['foo']['a'])
+        self.assert_(config['foo']['a']._on_update is config['bar']['c']._on_update)
+
+    def test_snapshot(self):
+        self._write_config(self.example_config1)
+        config = ConfigFile(self.cfgpath)
+        before = config.snapshot
+
+        seen = []
+        config('bar', 'c', update_cb=lambda value: seen.append(config('bar', 'd')))
+        self._write_config(self.example_config2)
+        config.update()
+
+        self.assertEquals(['rawr'], seen)
+        self.assertEquals('14', before.raw('bar', 'c'))
+        self.assertEquals('44', config.snapshot.raw('bar', 'c'))
+
+    def test_rejected(self):
+        self._write_config(self.example_config1)
+        schema = ConfigSchema({'bar' : {'d' : ('int', 0)}})
+        config = ConfigFile(self.cfgpath, validators=[schema.validate])
+        live = config.snapshot
+
+        self._write_config(self.example_config2)
+        self.assertRaises(ConfigError, config.update)
+        self._write_config("no section header\n")
+        self.assertRaises(ConfigError, config.update)
+        self.assert_(config.snapshot is live)
+        self.assertEquals(9, config('bar', 'd', transform=int))
+
+        self._write_config(self.example_config1.replace("c: 14", "c: 15"))
+        self.assertEquals(True, config.update())
+        self.assertEquals(None, config.error)
+        self.assertEquals(15, config('bar', 'c', transform=int))
+
+    def test_invalid_initial(self):
+        self._write_config(self.example_config2)
+        schema = ConfigSchema({'bar' : {'d' : ('int', 0)}})
+        config = ConfigFile(self.cfgpath, validators=[schema.validate])
+
+        self.assert_(isinstance(config.error, ConfigError))
+        self.assertEquals(44, config('bar', 'c', transform=int))
+        settings = schema.compile(config)
+        self.assertEquals(0, settings.bar.d.value)
+        self.assert_(isinstance(settings.bar.d.error, ValueError))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,190 @@
+"""
+control.py
+
+All classes/definitions in this file should pertain to the unix control
+socket through which a running daemon is queried and commanded.
+
+The protocol is one JSON object per line in each direction:
+
+    -> {"command": "status", "args": []}
+    <- {"ok": true, "result": {...}}
+    <- {"ok": false, "error": "Unknown command 'foo'"}
+
+A connection may carry any number of requests.
+"""
+import os
+import json
+import errno
+import fcntl
+import select
+import socket
+import threading
+
+from daemonhelper.exceptions import ControlError
+
+def _set_cloexec(fd):
+    """Keep fd out of processes exec'd by the daemon, such as a graceful restart."""
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+class ControlServer(object):
+    """
+    Serve commands on a unix socket from a background thread. commands maps
+    a command name to a function taking the request's args; its return value
+    must be JSON serializable. Commands run on the control thread.
+    """
+    def __init__(self, path, commands):
+        self.path = path
+        self.commands = commands
+        if os.path.exists(path):
+            os.unlink(path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _set_cloexec(self._listener.fileno())
+        self._listener.bind(path)
+        self._listener.listen(16)
+        self._inode = os.stat(path).st_ino
+        self._clients = {}
+        self._running = False
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        _set_cloexec(self._wakeup_r)
+        _set_cloexec(self._wakeup_w)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="control-socket")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop serving and remove the socket."""
+        if self._running:
+            self._running = False
+            os.write(self._wakeup_w, "x")
+            self._thread.join(1.0)
+        for conn in self._clients.keys():
+            conn.close()
+        self._clients.clear()
+        self._listener.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        try:
+            # A replacement process may have bound a new socket at our path
+            if os.stat(self.path).st_ino == self._inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _run(self):
+        while self._running:
+            try:
+                readable, _, _ = select.select([self._listener, self._wakeup_r] + self._clients.keys(), [], [])
+            except select.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sock in readable:
+                if sock is self._listener:
+                    conn, _ = self._listener.accept()
+                    _set_cloexec(conn.fileno())
+                    self._clients[conn] = ""
+                elif sock is not self._wakeup_r:
+                    self._read(sock)
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(65536)
+        except socket.error:
+            data = ""
+        if not data:
+            del self._clients[conn]
+            conn.close()
+            return
+        buffered = self._clients[conn] + data
+        lines = buffered.split("\n")
+        self._clients[conn] = lines.pop()
+        try:
+            for line in lines:
+                if line.strip():
+                    conn.sendall(json.dumps(self.handle(line)) + "\n")
+        except socket.error:
+            del self._clients[conn]
+            conn.close()
+
+    def handle(self, line):
+        """Run one request line, returning the reply object."""
+        try:
+            request = json.loads(line)
+            name = request["command"]
+            command = self.commands.get(name)
+            if command is None:
+                raise ControlError("Unknown command '%s'" % name)
+            return {"ok" : True, "result" : command(*request.get("args", []))}
+        except Exception as ex:
+            return {"ok" : False, "error" : "%s: %s" % (ex.__class__.__name__, ex)}
+
+class ControlClient(object):
+    """Persistent client connection to a daemon's control socket."""
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._buffer = ""
+
+    def call(self, command, *args):
+        """
+        Run a command in the daemon.
+        @return the command's result
+        @raise ControlError if the command failed
+        """
+        self._sock.sendall(json.dumps({"command" : command, "args" : args}) + "\n")
+        while "\n" not in self._buffer:
+            data = self._sock.recv(65536)
+            if not data:
+                raise ControlError("Control socket closed by daemon")
+            self._buffer += data
+        line, self._buffer = self._buffer.split("\n", 1)
+        reply = json.loads(line)
+        if not reply["ok"]:
+            raise ControlError(reply["error"])
+        return reply["result"]
+
+    def close(self):
+        self._sock.close()
+
+import unittest, tempfile, shutil
+
+class TestControl(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.sock")
+        self.server = ControlServer(self.path, {
+            "echo" : lambda *args: list(args),
+            "fail" : lambda: 1 / 0,
+        })
+        self.server.start()
+        self.client = ControlClient(self.path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_call(self):
+        self.assertEquals(["a", 1], self.client.call("echo", "a", 1))
+        self.assertEquals([], self.client.call("echo"))
+
+    def test_errors(self):
+        self.assertRaises(ControlError, self.client.call, "nope")
+        self.assertRaises(ControlError, self.client.call, "fail")
+        self.assertEquals([2], self.client.call("echo", 2))
+
+    def test_close_removes_socket(self):
+        self.client.close()
+        self.server.close()
+        self.assertEquals(False, os.path.exists(self.path))
+        self.server = ControlServer(self.path, {})
+        self.server.start()
+        self.client = ControlClient(self.path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,3 +18,20 @@ class DaemonRunning(Exception):
     """
     def __init__(self):
         Exception.__init__(self, "Daemon is running")
+
+class DaemonStartFailed(Exception):
+    """
+    Raised when the daemon fails before reporting that it is ready.
+    """
+    def __init__(self, reason):
+        Exception.__init__(self, "Daemon failed to start: %s" % reason)
+
+class ControlError(Exception):
+    """
+    Raised when a control socket command fails.
+    """
+
+class ConfigError(Exception):
+    """
+    Raised when a config file can't be parsed or fails validation.
+    """
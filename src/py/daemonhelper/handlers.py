@@ -0,0 +1,434 @@
+"""
+handlers.py
+
+All classes/definitions in this file should pertain to logging handlers
+used by the python-daemonhelper project.
+"""
+import os
+import time
+import Queue
+import select
+import socket
+import logging
+import threading
+import collections
+import logging.handlers
+
+_STOP = object()
+
+def handle_batch(handler, records, flush=True):
+    """
+    Hand a batch of records to one handler under a single lock, in one
+    emit_batch call when the handler has one. flush waits for the handler
+    to ship them, so leave it off where logging must not block.
+    """
+    records = [record for record in records if record.levelno >= handler.level]
+    if not records:
+        return
+    handler.acquire()
+    try:
+        emit_batch = getattr(handler, "emit_batch", None)
+        if emit_batch is not None:
+            emit_batch([record for record in records if handler.filter(record)])
+        else:
+            for record in records:
+                if handler.filter(record):
+                    handler.emit(record)
+        if flush:
+            handler.flush()
+    except Exception:
+        handler.handleError(records[-1])
+    finally:
+        handler.release()
+
+class QueueHandler(logging.Handler):
+    """
+    Logging handler which only enqueues records. A background thread takes
+    them off a bounded queue and hands them to the real handlers in batches,
+    so a slow syslog never stalls the code doing the logging.
+
+    When the queue is full, the "drop" overflow policy discards the record
+    (counting it in self.dropped) and "block" waits for room.
+    """
+    DROP = "drop"
+    BLOCK = "block"
+
+    def __init__(self, handlers, maxsize=10000, overflow=DROP, batch_size=256):
+        logging.Handler.__init__(self)
+        if overflow not in (self.DROP, self.BLOCK):
+            raise ValueError("Unknown overflow policy %r" % overflow)
+        self.handlers = list(handlers)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._start()
+
+    def _start(self):
+        """Create the queue and worker thread for the current process."""
+        self._pid = os.getpid()
+        self.queue = Queue.Queue(self.maxsize)
+        self._thread = threading.Thread(target=self._run, name="logging-queue")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        # Threads do not survive fork, so the first record logged in a
+        # forked child gets a fresh queue and worker thread.
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            if self.overflow == self.BLOCK:
+                self.queue.put(record)
+            else:
+                self.dropped += 1
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            stop = _STOP in batch
+            records = [record for record in batch if record is not _STOP]
+            try:
+                for handler in self.handlers:
+                    handle_batch(handler, records)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+            if stop:
+                return
+
+    def flush(self, timeout=5.0):
+        """Wait until every queued record has been shipped."""
+        if self._pid != os.getpid():
+            return
+        deadline = time.time() + timeout
+        done = self.queue.all_tasks_done
+        done.acquire()
+        try:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                done.wait(remaining)
+        finally:
+            done.release()
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self.flush()
+            try:
+                self.queue.put(_STOP, timeout=1.0)
+            except Queue.Full:
+                pass
+            self._thread.join(1.0)
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+class TCPSysLogHandler(logging.handlers.SysLogHandler):
+    """
+    Syslog over one persistent TCP (or unix stream) connection, framed with
+    RFC 6587 octet counting. Records are framed by the caller and appended to
+    a bounded buffer; a sender thread writes everything buffered in a single
+    sendall, so records logged while a write is in progress are coalesced
+    into the next one.
+
+    While the connection is down the sender reconnects with exponential
+    backoff and records stay buffered; once buffer_size records are waiting
+    the oldest are dropped (counted in self.dropped). A batch cut off by a
+    broken connection is resent in full after reconnecting.
+    """
+    close_timeout = 2.0
+
+    def __init__(self, address=("localhost", logging.handlers.SYSLOG_TCP_PORT),
+            facility=logging.handlers.SysLogHandler.LOG_USER,
+            buffer_size=10000, min_backoff=0.1, max_backoff=30.0):
+        logging.Handler.__init__(self)
+        self.address = address
+        self.facility = facility
+        self.buffer_size = buffer_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.dropped = 0
+        self._sock = None
+        self._closed = False
+        self._pid = None
+        self._cond = threading.Condition(threading.Lock())
+
+    def _start(self):
+        """Create the buffer and sender thread for the current process."""
+        self._pid = os.getpid()
+        self._sock = None
+        self._buffer = collections.deque()
+        self._inflight = 0
+        self._thread = threading.Thread(target=self._run, name="syslog-tcp")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def frame(self, record):
+        """Format a record as one octet-counted syslog frame."""
+        msg = "<%d>%s" % (self.encodePriority(self.facility, self.mapPriority(record.levelname)),
+                self.format(record))
+        if isinstance(msg, unicode):
+            msg = msg.encode("utf-8")
+        return "%d %s" % (len(msg), msg)
+
+    def emit(self, record):
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        frames = []
+        for record in records:
+            try:
+                frames.append(self.frame(record))
+            except Exception:
+                self.handleError(record)
+        self._cond.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._start()
+            self._buffer.extend(frames)
+            while len(self._buffer) > self.buffer_size:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _connect(self):
+        if isinstance(self.address, basestring):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect(self.address)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def _peer_closed(self):
+        """Check whether the server hung up since our last write."""
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self._sock.recv(1, socket.MSG_PEEK) == ""
+        except socket.error:
+            return True
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _run(self):
+        backoff = self.min_backoff
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                if not self._buffer:
+                    return
+                frames = list(self._buffer)
+                self._buffer.clear()
+                self._inflight = len(frames)
+            finally:
+                self._cond.release()
+
+            try:
+                if self._sock is not None and self._peer_closed():
+                    self._disconnect()
+                if self._sock is None:
+                    self._sock = self._connect()
+                self._sock.sendall("".join(frames))
+                backoff = self.min_backoff
+                frames = []
+            except (socket.error, IOError, OSError):
+                self._disconnect()
+
+            self._cond.acquire()
+            try:
+                self._inflight = 0
+                if frames:
+                    # Put the batch back in front of anything logged since
+                    room = max(0, self.buffer_size - len(self._buffer))
+                    keep = frames[max(0, len(frames) - room):]
+                    self.dropped += len(frames) - len(keep)
+                    self._buffer.extendleft(reversed(keep))
+                    if self._closed:
+                        self.dropped += len(self._buffer)
+                        self._buffer.clear()
+                        return
+                    self._cond.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+
+    def flush(self, timeout=5.0):
+        """Wait until everything buffered has been written."""
+        deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            if self._pid != os.getpid():
+                return
+            while self._buffer or self._inflight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(min(remaining, 0.05))
+        finally:
+            self._cond.release()
+
+    def close(self):
+        if self._pid == os.getpid():
+            self.flush(self.close_timeout)
+            self._cond.acquire()
+            try:
+                self._closed = True
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+            self._thread.join(1.0)
+            self._disconnect()
+        logging.Handler.close(self)
+
+import unittest
+
+class _ListHandler(logging.Handler):
+    def __init__(self, delay=0):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.delay = delay
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.records.append(record.getMessage())
+
+class TestQueueHandler(unittest.TestCase):
+    def _record(self, msg):
+        return logging.LogRecord("test", logging.INFO, __file__, 0, msg, None, None)
+
+    def test_flush(self):
+        target = _ListHandler()
+        handler = QueueHandler([target])
+        for i in range(100):
+            handler.handle(self._record("msg %d" % i))
+        handler.flush()
+        self.assertEquals(["msg %d" % i for i in range(100)], target.records)
+        handler.close()
+
+    def test_drop(self):
+        target = _ListHandler(delay=0.05)
+        handler = QueueHandler([target], maxsize=2, overflow=QueueHandler.DROP, batch_size=1)
+        for i in range(10):
+            handler.handle(self._record("msg %d" % i))
+        handler.flush()
+        self.assert_(handler.dropped > 0)
+        self.assertEquals(10, len(target.records) + handler.dropped)
+        handler.close()
+
+    def test_block(self):
+        target = _ListHandler(delay=0.01)
+        handler = QueueHandler([target], maxsize=2, overflow=QueueHandler.BLOCK)
+        for i in range(10):
+            handler.handle(self._record("msg %d" % i))
+        handler.flush()
+        self.assertEquals(0, handler.dropped)
+        self.assertEquals(10, len(target.records))
+        handler.close()
+
+    def test_level(self):
+        target = _ListHandler()
+        target.setLevel(logging.WARNING)
+        handler = QueueHandler([target])
+        handler.handle(self._record("dropped by level"))
+        handler.flush()
+        self.assertEquals([], target.records)
+        handler.close()
+
+class _SyslogServer(object):
+    """Local stand-in for a TCP syslog server."""
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.listener.settimeout(5)
+        self.address = self.listener.getsockname()
+
+    def accept(self):
+        conn, _ = self.listener.accept()
+        conn.settimeout(5)
+        return conn
+
+    def read_frames(self, conn, count):
+        data = ""
+        frames = []
+        while len(frames) < count:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            while " " in data:
+                length, rest = data.split(" ", 1)
+                if len(rest) < int(length):
+                    break
+                frames.append(rest[:int(length)])
+                data = rest[int(length):]
+        return frames
+
+    def close(self):
+        self.listener.close()
+
+class TestTCPSysLogHandler(unittest.TestCase):
+    def _record(self, msg, level=logging.INFO):
+        return logging.LogRecord("test", level, __file__, 0, msg, None, None)
+
+    def setUp(self):
+        self.server = _SyslogServer()
+        self.handler = TCPSysLogHandler(self.server.address, min_backoff=0.01)
+
+    def tearDown(self):
+        self.handler.close()
+        self.server.close()
+
+    def test_octet_counting(self):
+        self.handler.handle(self._record("hello"))
+        self.handler.handle(self._record("a b c", logging.ERROR))
+        conn = self.server.accept()
+        self.assertEquals(["<14>hello", "<11>a b c"], self.server.read_frames(conn, 2))
+        conn.close()
+
+    def test_reconnect(self):
+        self.handler.handle(self._record("first"))
+        conn = self.server.accept()
+        self.assertEquals(["<14>first"], self.server.read_frames(conn, 1))
+        conn.close()
+        self.handler.handle(self._record("second"))
+        conn = self.server.accept()
+        self.assertEquals(["<14>second"], self.server.read_frames(conn, 1))
+        conn.close()
+
+    def test_buffer_while_down(self):
+        self.server.close()
+        self.handler.buffer_size = 3
+        self.handler.close_timeout = 0.1
+        for i in range(5):
+            self.handler.handle(self._record("msg %d" % i))
+        self.handler.flush(timeout=0.1)
+        self.assertEquals(2, self.handler.dropped)
+
+if __name__ == "__main__":
+    unittest.main()
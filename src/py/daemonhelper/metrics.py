@@ -0,0 +1,333 @@
+"""
+metrics.py
+
+All classes/definitions in this file should pertain to the lightweight
+metrics registry every daemon carries, and its Prometheus text exposition.
+
+Counters and histograms are sharded per thread: each thread updates its own
+list of cells without locking and readers sum the shards. An observation
+only touches existing cells, it never allocates containers.
+"""
+import os
+import time
+import bisect
+import tempfile
+import threading
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class _Sharded(object):
+    """Base for metrics whose cells are sharded per thread."""
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _new_cells(self):
+        return [0]
+
+    def _cells(self):
+        """This thread's cells, created on its first update."""
+        cells = self._new_cells()
+        with self._shards_lock:
+            self._shards.append(cells)
+        self._local.cells = cells
+        return cells
+
+class Counter(_Sharded):
+    """Monotonically increasing count."""
+    type = "counter"
+
+    def inc(self, amount=1):
+        try:
+            cells = self._local.cells
+        except AttributeError:
+            cells = self._cells()
+        cells[0] += amount
+
+    @property
+    def value(self):
+        return sum(cells[0] for cells in list(self._shards))
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+class Gauge(object):
+    """Value that can go up and down; set() is a single store."""
+    type = "gauge"
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def time(self):
+        """Context manager setting the gauge to the duration of its block."""
+        return _Timer(self.set)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+class Histogram(_Sharded):
+    """Distribution of observations over fixed, sorted bucket bounds."""
+    type = "histogram"
+
+    def __init__(self, name, labels, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        _Sharded.__init__(self, name, labels)
+
+    def _new_cells(self):
+        # One count per bucket, one for +Inf, then the sum
+        return [0] * (len(self.bounds) + 2)
+
+    def observe(self, value):
+        try:
+            cells = self._local.cells
+        except AttributeError:
+            cells = self._cells()
+        cells[bisect.bisect_left(self.bounds, value)] += 1
+        cells[-1] += value
+
+    def time(self):
+        """Context manager observing the duration of its block."""
+        return _Timer(self.observe)
+
+    def snapshot(self):
+        """(bucket counts incl. +Inf, sum) summed over all shards."""
+        totals = [0] * (len(self.bounds) + 2)
+        for cells in list(self._shards):
+            for i, value in enumerate(cells):
+                totals[i] += value
+        return totals[:-1], totals[-1]
+
+    @property
+    def count(self):
+        return sum(self.snapshot()[0])
+
+    def samples(self):
+        counts, total = self.snapshot()
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += count
+            yield self.name + "_bucket", self.labels + (("le", _format_value(bound)),), cumulative
+        yield self.name + "_sum", self.labels, total
+        yield self.name + "_count", self.labels, cumulative
+
+class _Timer(object):
+    def __init__(self, record):
+        self.record = record
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.record(time.time() - self.started)
+
+class Registry(object):
+    """
+    Named metrics, created on first use. Label values are passed as keyword
+    arguments and each combination is its own metric:
+
+    registry.counter("requests_total", "Requests served", method="GET").inc()
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, factory, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.iteritems())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory(name, key[1], *args)
+                    self._help.setdefault(name, (help, metric.type))
+        return metric
+
+    def counter(self, name, help="", **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def collect(self):
+        """Every sample as {"name{labels}": value}, e.g. for JSON."""
+        return dict((sample + _format_labels(labels), value)
+                for metric in self._metrics.values()
+                for sample, labels, value in metric.samples())
+
+    def expose(self):
+        """Render every metric in the Prometheus text format."""
+        lines = []
+        for name in sorted(self._help):
+            help, type_ = self._help[name]
+            lines.append("# HELP %s %s" % (name, help.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE %s %s" % (name, type_))
+            for key in sorted(key for key in self._metrics.keys() if key[0] == name):
+                for sample, labels, value in self._metrics[key].samples():
+                    lines.append("%s%s %s" % (sample, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the exposition to path atomically (temp file and rename)."""
+        directory = os.path.dirname(path)
+        fd, tmp_path = tempfile.mkstemp(prefix=".metrics-", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as tmp:
+                tmp.write(self.expose())
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n")) for key, value in labels)
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class MetricsWriter(object):
+    """
+    Background thread writing a registry to a text file every interval
+    seconds. A failed write is logged and never raised, so neither the
+    thread nor the daemon's shutdown dies of a full disk.
+    """
+    def __init__(self, registry, path, interval, logger=None):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._logger = logger
+        self._stop = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread and write one final time."""
+        self._stop.set()
+        self._thread.join(1.0)
+        self._write()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._write()
+            self._stop.wait(self.interval)
+
+    def _write(self):
+        try:
+            self.registry.write(self.path)
+        except (IOError, OSError) as ex:
+            if self._logger is not None:
+                self._logger.error("Could not write metrics to %s: %s" % (self.path, ex))
+
+import unittest, shutil, logging
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_threads(self):
+        registry = Registry()
+        counter = registry.counter("hits_total", "Hits")
+        def work():
+            for _ in range(10000):
+                counter.inc()
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(40000, counter.value)
+        self.assert_(counter is registry.counter("hits_total"))
+
+    def test_histogram(self):
+        histogram = Registry().histogram("latency_seconds", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertEquals(([2, 1, 1], 3.65), histogram.snapshot())
+        self.assertEquals(4, histogram.count)
+
+    def test_expose(self):
+        registry = Registry()
+        registry.counter("restarts_total", "Restarts", child='a"b').inc(2)
+        registry.gauge("up", "Up").set(1)
+        registry.histogram("t_seconds", "T", buckets=(1,)).observe(0.5)
+        self.assertEquals("\n".join([
+            '# HELP restarts_total Restarts',
+            '# TYPE restarts_total counter',
+            'restarts_total{child="a\\"b"} 2',
+            '# HELP t_seconds T',
+            '# TYPE t_seconds histogram',
+            't_seconds_bucket{le="1"} 1',
+            't_seconds_bucket{le="+Inf"} 1',
+            't_seconds_sum 0.5',
+            't_seconds_count 1',
+            '# HELP up Up',
+            '# TYPE up gauge',
+            'up 1',
+        ]) + "\n", registry.expose())
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            registry = Registry()
+            registry.gauge("up").set(1)
+            path = os.path.join(directory, "metrics.prom")
+            registry.write(path)
+            self.assertEquals(registry.expose(), open(path).read())
+            self.assertEquals(["metrics.prom"], os.listdir(directory))
+            self.assertEquals({"up": 1}, registry.collect())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_writer_failure(self):
+        directory = tempfile.mkdtemp()
+        errors = []
+        logger = logging.getLogger("test-metrics-writer")
+        handler = logging.Handler()
+        handler.emit = lambda record: errors.append(record.getMessage())
+        logger.addHandler(handler)
+        try:
+            path = os.path.join(directory, "metrics.prom")
+            writer = MetricsWriter(Registry(), path, 60, logger)
+            writer.start()
+            while not os.path.exists(path):
+                time.sleep(0.01)
+            shutil.rmtree(directory)
+            writer.stop()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEquals(1, len(errors))
+        self.assert_(errors[0].startswith("Could not write metrics to %s" % directory))
+
+if __name__ == "__main__":
+    unittest.main()
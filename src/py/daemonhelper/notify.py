@@ -0,0 +1,155 @@
+"""
+notify.py
+
+All classes/definitions in this file should pertain to telling whoever
+started a daemon that it is ready (or that it failed to start).
+"""
+import os
+import time
+import errno
+import fcntl
+import select
+import socket
+
+def sd_notify(state, environ=os.environ):
+    """
+    Send a state string such as "READY=1" to the systemd notify socket.
+    @return True if NOTIFY_SOCKET was set and the state was sent
+    """
+    address = environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address[0] == "@":
+        address = "\0" + address[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(address)
+        sock.sendall(state)
+    finally:
+        sock.close()
+    return True
+
+class ReadinessPipe(object):
+    """
+    Pipe from a daemon process back to the process that launched it. The
+    daemon writes a single "READY" or "ERROR <message>" line; the launcher
+    blocks in wait() until it arrives or the daemon goes away.
+    """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def _close(self, attr):
+        fd = getattr(self, attr)
+        if fd is not None:
+            os.close(fd)
+            setattr(self, attr, None)
+
+    def close_read(self):
+        self._close("read_fd")
+
+    def close_write(self):
+        self._close("write_fd")
+
+    def _send(self, line):
+        if self.write_fd is None:
+            return
+        try:
+            os.write(self.write_fd, line + "\n")
+        except OSError as ex:
+            if ex.args[0] != errno.EPIPE:
+                raise
+        finally:
+            self.close_write()
+
+    def ready(self):
+        self._send("READY")
+
+    def failed(self, message):
+        self._send("ERROR " + " ".join(str(message).split()))
+
+    def wait(self, timeout=None):
+        """
+        Wait for the daemon's message.
+        @return (True, None) once ready, or (False, reason)
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        data = ""
+        try:
+            while "\n" not in data:
+                remaining = deadline and deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False, "not ready after %ss" % timeout
+                try:
+                    readable, _, _ = select.select([self.read_fd], [], [], remaining)
+                except select.error as ex:
+                    if ex.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if not readable:
+                    continue
+                chunk = os.read(self.read_fd, 4096)
+                if not chunk:
+                    return False, "exited before becoming ready"
+                data += chunk
+        finally:
+            self.close_read()
+        line = data.split("\n", 1)[0]
+        if line == "READY":
+            return True, None
+        return False, line.startswith("ERROR ") and line[6:] or line
+
+import unittest, tempfile, shutil
+
+class TestNotify(unittest.TestCase):
+    def test_sd_notify(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "notify")
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            server.bind(path)
+            self.assertEquals(True, sd_notify("READY=1", {"NOTIFY_SOCKET" : path}))
+            self.assertEquals("READY=1", server.recv(1024))
+            server.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sd_notify_abstract(self):
+        name = "daemonhelper-test-%d" % os.getpid()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        server.bind("\0" + name)
+        self.assertEquals(True, sd_notify("READY=1", {"NOTIFY_SOCKET" : "@" + name}))
+        self.assertEquals("READY=1", server.recv(1024))
+        server.close()
+
+    def test_sd_notify_unset(self):
+        self.assertEquals(False, sd_notify("READY=1", {}))
+
+    def _fork(self, func):
+        pipe = ReadinessPipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                pipe.close_read()
+                func(pipe)
+            finally:
+                os._exit(0)
+        pipe.close_write()
+        result = pipe.wait(5)
+        os.waitpid(pid, 0)
+        return result
+
+    def test_ready(self):
+        self.assertEquals((True, None), self._fork(lambda pipe: pipe.ready()))
+
+    def test_failed(self):
+        self.assertEquals((False, "no such user: bob"),
+                self._fork(lambda pipe: pipe.failed("no such user:\nbob")))
+
+    def test_exited(self):
+        self.assertEquals((False, "exited before becoming ready"), self._fork(lambda pipe: None))
+
+if __name__ == "__main__":
+    unittest.main()
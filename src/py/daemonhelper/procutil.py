@@ -0,0 +1,288 @@
+"""
+procutil.py
+
+All classes/definitions in this file should pertain to low-level process
+helpers which the standard library does not provide.
+"""
+import os
+import imp
+import time
+import errno
+import select
+
+# pidfd_open has the same syscall number on every Linux architecture (5.3+)
+_NR_PIDFD_OPEN = 434
+
+_libc = []
+
+def module_available(name):
+    """Check whether a top-level module can be imported, without importing it."""
+    try:
+        handle = imp.find_module(name)
+    except ImportError:
+        return False
+    if handle[0] is not None:
+        handle[0].close()
+    return True
+
+def libc():
+    """The C library through ctypes, or None if it can't be loaded."""
+    if not _libc:
+        try:
+            import ctypes
+            _libc.append(ctypes.CDLL(None, use_errno=True))
+        except (ImportError, OSError):
+            _libc.append(None)
+    return _libc[0]
+
+def syscall_errno():
+    """errno of the last failed ctypes call."""
+    import ctypes
+    return ctypes.get_errno()
+
+# Room for 1024 CPUs, glibc's default cpu_set_t
+_CPU_SET_WORDS = 1024 // 64
+
+def sched_setaffinity(pid, cpus):
+    """os.sched_setaffinity, through libc where os lacks it (Python 2)."""
+    if hasattr(os, "sched_setaffinity"):
+        return os.sched_setaffinity(pid, cpus)
+    import ctypes
+    mask = (ctypes.c_uint64 * _CPU_SET_WORDS)()
+    for cpu in cpus:
+        mask[cpu // 64] |= 1 << (cpu % 64)
+    if libc().sched_setaffinity(pid, ctypes.sizeof(mask), mask) != 0:
+        code = syscall_errno()
+        raise OSError(code, os.strerror(code))
+
+def sched_getaffinity(pid):
+    """os.sched_getaffinity, through libc where os lacks it (Python 2)."""
+    if hasattr(os, "sched_getaffinity"):
+        return os.sched_getaffinity(pid)
+    import ctypes
+    mask = (ctypes.c_uint64 * _CPU_SET_WORDS)()
+    if libc().sched_getaffinity(pid, ctypes.sizeof(mask), mask) != 0:
+        code = syscall_errno()
+        raise OSError(code, os.strerror(code))
+    return set(word * 64 + bit for word in range(_CPU_SET_WORDS)
+            for bit in range(64) if mask[word] >> bit & 1)
+
+def _check(result):
+    """Raise OSError for a failed (-1) libc call."""
+    if result == -1:
+        code = syscall_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+PRIO_PROCESS = 0
+
+def setpriority(niceness, pid=0):
+    """os.setpriority(PRIO_PROCESS, ...), through libc where os lacks it."""
+    if hasattr(os, "setpriority"):
+        return os.setpriority(os.PRIO_PROCESS, pid, niceness)
+    _check(libc().setpriority(PRIO_PROCESS, pid, niceness))
+
+def getpriority(pid=0):
+    """os.getpriority(PRIO_PROCESS, ...), through libc where os lacks it."""
+    if hasattr(os, "getpriority"):
+        return os.getpriority(os.PRIO_PROCESS, pid)
+    import ctypes
+    # -1 is a valid niceness, so only errno tells failures apart
+    ctypes.set_errno(0)
+    niceness = libc().getpriority(PRIO_PROCESS, pid)
+    if niceness == -1 and syscall_errno():
+        _check(-1)
+    return niceness
+
+SCHED_POLICIES = {
+    "other" : 0,
+    "fifo"  : 1,
+    "rr"    : 2,
+    "batch" : 3,
+    "idle"  : 5,
+}
+
+def sched_setscheduler(policy, priority=0, pid=0):
+    """os.sched_setscheduler, through libc where os lacks it."""
+    if hasattr(os, "sched_setscheduler"):
+        return os.sched_setscheduler(pid, policy, os.sched_param(priority))
+    import ctypes
+    param = ctypes.c_int(priority)
+    _check(libc().sched_setscheduler(pid, policy, ctypes.byref(param)))
+
+def sched_getscheduler(pid=0):
+    """(policy, priority) of a process."""
+    if hasattr(os, "sched_getscheduler"):
+        return os.sched_getscheduler(pid), os.sched_getparam(pid).sched_priority
+    import ctypes
+    param = ctypes.c_int(0)
+    policy = _check(libc().sched_getscheduler(pid))
+    _check(libc().sched_getparam(pid, ctypes.byref(param)))
+    return policy, param.value
+
+IOPRIO_CLASSES = {
+    "realtime"    : 1,
+    "best-effort" : 2,
+    "idle"        : 3,
+}
+
+# ioprio_set/ioprio_get have no libc wrappers and per-architecture numbers
+_NR_IOPRIO = {
+    "x86_64"  : (251, 252),
+    "i386"    : (289, 290),
+    "i686"    : (289, 290),
+    "aarch64" : (30, 31),
+    "armv7l"  : (314, 315),
+    "ppc64le" : (273, 274),
+    "s390x"   : (282, 283),
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+def _ioprio_syscalls():
+    numbers = _NR_IOPRIO.get(os.uname()[4])
+    if numbers is None or libc() is None:
+        raise OSError(errno.ENOSYS, "ioprio syscalls unknown on %s" % os.uname()[4])
+    return numbers
+
+def ioprio_set(ioclass, level=0, pid=0):
+    """Set the I/O scheduling class (IOPRIO_CLASSES) and level (0-7)."""
+    set_nr, _ = _ioprio_syscalls()
+    _check(libc().syscall(set_nr, _IOPRIO_WHO_PROCESS, pid, (ioclass << _IOPRIO_CLASS_SHIFT) | level))
+
+def ioprio_get(pid=0):
+    """(I/O scheduling class, level) of a process."""
+    _, get_nr = _ioprio_syscalls()
+    value = _check(libc().syscall(get_nr, _IOPRIO_WHO_PROCESS, pid))
+    return value >> _IOPRIO_CLASS_SHIFT, value & ((1 << _IOPRIO_CLASS_SHIFT) - 1)
+
+def pidfd_open(pid):
+    """
+    Open a pidfd, which becomes readable when the process exits.
+    @return the fd, or None where pidfds are unsupported
+    @raise OSError(ESRCH) if there is no such process
+    """
+    if hasattr(os, "pidfd_open"):
+        try:
+            return os.pidfd_open(pid)
+        except OSError as ex:
+            if ex.errno == errno.ESRCH:
+                raise
+            return None
+    lib = libc()
+    if lib is None or not hasattr(lib, "syscall"):
+        return None
+    fd = lib.syscall(_NR_PIDFD_OPEN, pid, 0)
+    if fd < 0:
+        err = syscall_errno()
+        if err == errno.ESRCH:
+            raise OSError(errno.ESRCH, os.strerror(errno.ESRCH))
+        return None
+    return fd
+
+def process_exists(pid):
+    """Check for a process with signal 0."""
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        if ex.args[0] == errno.ESRCH:
+            return False
+        if ex.args[0] != errno.EPERM:
+            raise
+    return True
+
+def wait_for_exit(pid, timeout=None):
+    """
+    Block until a process (not necessarily our child) exits, without
+    polling where pidfds are available; otherwise poll with exponential
+    backoff starting at 1ms.
+    @return True if the process is gone, False if timeout ran out first
+    """
+    deadline = timeout is not None and time.time() + timeout or None
+    try:
+        fd = pidfd_open(pid)
+    except OSError:
+        return True
+
+    if fd is not None:
+        try:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            while True:
+                remaining = deadline and max(0, deadline - time.time())
+                try:
+                    if poller.poll(remaining is None and -1 or remaining * 1000):
+                        return True
+                except select.error as ex:
+                    if ex.args[0] != errno.EINTR:
+                        raise
+                if deadline and time.time() >= deadline:
+                    return False
+        finally:
+            os.close(fd)
+
+    delay = 0.001
+    while process_exists(pid):
+        if deadline:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return True
+
+import unittest, signal, threading
+
+class TestWaitForExit(unittest.TestCase):
+    use_pidfds = True
+
+    def setUp(self):
+        global pidfd_open
+        self._pidfd_open = pidfd_open
+        if not self.use_pidfds:
+            pidfd_open = lambda pid: None
+        elif pidfd_open(os.getpid()) is None:
+            self.skipTest("pidfds are unsupported")
+
+    def tearDown(self):
+        global pidfd_open
+        pidfd_open = self._pidfd_open
+
+    def _fork(self, seconds):
+        """Fork a child exiting after seconds, reaped on exit as a real parent would."""
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(seconds)
+            os._exit(0)
+        reaper = threading.Thread(target=os.waitpid, args=(pid, 0))
+        reaper.start()
+        self.addCleanup(reaper.join)
+        self.addCleanup(self._kill, pid)
+        return pid
+
+    def _kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    def test_exit(self):
+        pid = self._fork(0.1)
+        started = time.time()
+        self.assertEquals(True, wait_for_exit(pid, 5))
+        self.assert_(time.time() - started < 1)
+
+    def test_timeout(self):
+        pid = self._fork(5)
+        started = time.time()
+        self.assertEquals(False, wait_for_exit(pid, 0.2))
+        self.assert_(0.2 <= time.time() - started < 1)
+        self.assertEquals(True, process_exists(pid))
+
+class TestWaitForExitPolling(TestWaitForExit):
+    use_pidfds = False
+
+if __name__ == "__main__":
+    unittest.main()
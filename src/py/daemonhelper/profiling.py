@@ -0,0 +1,137 @@
+"""
+profiling.py
+
+All classes/definitions in this file should pertain to profiling a running
+daemon process on demand.
+
+Both profilers are started and stopped from the main thread, in a signal
+handler, so they see the thread that runs handle_run.
+"""
+import os
+import sys
+import signal
+
+class StackSampler(object):
+    """
+    Low overhead statistical profiler. Every interval seconds of CPU time
+    SIGPROF interrupts the main thread and its stack is counted. Under
+    gevent each stack is prefixed with the running greenlet. write() saves
+    the counts as collapsed stacks, one "frame;frame;... count" per line,
+    as read by flamegraph.pl and speedscope.
+    """
+    extension = "collapsed"
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self._names = {}
+        self._previous = None
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        # Don't let samples interrupt blocking syscalls with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        names = self._names
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            name = names.get(code)
+            if name is None:
+                name = names[code] = "%s (%s:%d)" % (code.co_name,
+                        os.path.basename(code.co_filename), code.co_firstlineno)
+            stack.append(name)
+            frame = frame.f_back
+        task = _current_greenlet()
+        if task is not None:
+            stack.append(task)
+        stack.reverse()
+        key = ";".join(stack)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self, path):
+        with open(path, "w") as fd:
+            for stack, count in sorted(self.counts.iteritems()):
+                fd.write("%s %d\n" % (stack, count))
+
+def _current_greenlet():
+    """Name of the running greenlet, or None when greenlet isn't in use."""
+    greenlet = sys.modules.get("greenlet")
+    if greenlet is None:
+        return None
+    current = greenlet.getcurrent()
+    if current.parent is None:
+        return "greenlet:main"
+    name = getattr(current, "name", None) or "%s-%x" % (type(current).__name__, id(current))
+    return "greenlet:%s" % name
+
+class CProfiler(object):
+    """Deterministic profiler: cProfile on the main thread, saved as pstats."""
+    extension = "pstats"
+
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+PROFILERS = {
+    "sample"   : StackSampler,
+    "cprofile" : CProfiler,
+}
+
+import unittest, time, tempfile, shutil
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _spin(self, seconds):
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            pass
+
+    def test_sampler(self):
+        sampler = StackSampler(0.001)
+        sampler.start()
+        try:
+            self._spin(0.2)
+        finally:
+            sampler.stop()
+        self.assert_(sampler.counts)
+        self.assert_(any("_spin (profiling.py" in stack for stack in sampler.counts))
+        path = os.path.join(self.tmpdir, "out.collapsed")
+        sampler.write(path)
+        for line in open(path):
+            stack, count = line.rsplit(" ", 1)
+            self.assert_(int(count) > 0)
+
+    def test_cprofile(self):
+        import pstats
+        profiler = CProfiler()
+        profiler.start()
+        self._spin(0.01)
+        profiler.stop()
+        path = os.path.join(self.tmpdir, "out.pstats")
+        profiler.write(path)
+        functions = [func for _, _, func in pstats.Stats(path).stats]
+        self.assert_("_spin" in functions)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+"""
+signals.py
+
+All classes/definitions in this file should pertain to deferring signal
+handling out of the signal handler itself, to a point where the daemon can
+safely run arbitrary code.
+"""
+import os
+import time
+import errno
+import fcntl
+import select
+import signal
+import threading
+import collections
+
+def signal_name(signum):
+    """SIGHUP style name of a signal number."""
+    for name, value in vars(signal).iteritems():
+        if value == signum and name.startswith("SIG") and not name.startswith("SIG_"):
+            return name
+    return str(signum)
+
+class SignalQueue(object):
+    """
+    Self-pipe signal queue. The real signal handler only records which
+    signal arrived and writes a byte to a pipe; dispatch() later runs the
+    registered handler once per pending signal, however many times it
+    arrived meanwhile, and records the delay since its first arrival in
+    the daemon_signal_dispatch_seconds histogram.
+
+    Dispatch from an event loop by polling fileno() and calling dispatch()
+    when it is readable, from a plain loop with wait() or sleep(), or from
+    a background thread with start().
+    """
+    def __init__(self, metrics=None, logger=None):
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self._arrivals = collections.deque()
+        self._handlers = {}
+        self._latency = {}
+        self._metrics = metrics
+        self._logger = logger
+        self._thread = None
+        self._closed = False
+
+    def register(self, signum, handler):
+        """
+        Install a signal handler that queues signum for handler(), which
+        takes no arguments. A handler of None only wakes up the waiter.
+        Syscalls interrupted by a queued signal are restarted.
+        """
+        self._handlers[signum] = handler
+        if self._metrics is not None and handler is not None:
+            self._latency[signum] = self._metrics.histogram("daemon_signal_dispatch_seconds",
+                    "Seconds from a signal arriving to its handler running", signal=signal_name(signum))
+        signal.signal(signum, self._record)
+        signal.siginterrupt(signum, False)
+
+    def _record(self, signum, frame):
+        self._arrivals.append((signum, time.time()))
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._write_fd, "\0")
+        except OSError as ex:
+            # A full pipe already guarantees a wakeup
+            if ex.args[0] != errno.EAGAIN:
+                raise
+
+    def fileno(self):
+        return self._read_fd
+
+    def pending(self):
+        return bool(self._arrivals)
+
+    def dispatch(self):
+        """
+        Run the handler of every pending signal once, in arrival order.
+        @return the number of handlers run
+        """
+        # Drain before taking arrivals, so a signal landing in between
+        # leaves a byte behind and is picked up by the next wait
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as ex:
+            if ex.args[0] != errno.EAGAIN:
+                raise
+        first = {}
+        order = []
+        while self._arrivals:
+            signum, arrived = self._arrivals.popleft()
+            if signum not in first:
+                first[signum] = arrived
+                order.append(signum)
+        now = time.time()
+        dispatched = 0
+        for signum in order:
+            handler = self._handlers.get(signum)
+            if handler is None:
+                continue
+            latency = self._latency.get(signum)
+            if latency is not None:
+                latency.observe(now - first[signum])
+            handler()
+            dispatched += 1
+        return dispatched
+
+    def wait(self, timeout=None):
+        """Block until a signal arrives or timeout passes, then dispatch."""
+        if not self._arrivals:
+            try:
+                select.select([self._read_fd], [], [], timeout)
+            except select.error as ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+        return self.dispatch()
+
+    def sleep(self, seconds):
+        """time.sleep that dispatches signals as they arrive."""
+        if self._thread is not None:
+            time.sleep(seconds)
+            return
+        deadline = time.time() + seconds
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.dispatch()
+                return
+            self.wait(remaining)
+
+    def start(self):
+        """Dispatch from a background thread instead."""
+        self._thread = threading.Thread(target=self._run, name="signal-dispatch")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                self.wait()
+            except Exception as ex:
+                if self._logger is not None:
+                    self._logger.error("Signal handler failed")
+                    self._logger.exception(ex)
+
+    def close(self):
+        """Stop dispatching, restoring the default action of signals still routed here."""
+        self._closed = True
+        for signum in self._handlers:
+            if signal.getsignal(signum) == self._record:
+                signal.signal(signum, signal.SIG_DFL)
+        if self._thread is not None:
+            self._wake()
+            if self._thread is not threading.current_thread():
+                self._thread.join(1.0)
+            self._thread = None
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+import unittest
+
+class TestSignalQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = SignalQueue()
+        self.calls = []
+        self.queue.register(signal.SIGUSR1, lambda: self.calls.append("usr1"))
+        self.queue.register(signal.SIGUSR2, lambda: self.calls.append("usr2"))
+
+    def tearDown(self):
+        self.queue.close()
+        self.assertEquals(signal.SIG_DFL, signal.getsignal(signal.SIGUSR1))
+
+    def test_coalesce(self):
+        for signum in [signal.SIGUSR2, signal.SIGUSR1, signal.SIGUSR2, signal.SIGUSR2]:
+            os.kill(os.getpid(), signum)
+        self.assertEquals([], self.calls)
+        self.assertEquals(2, self.queue.wait(0))
+        self.assertEquals(["usr2", "usr1"], self.calls)
+        self.assertEquals(0, self.queue.wait(0))
+
+    def test_sleep(self):
+        started = time.time()
+        threading.Timer(0.05, os.kill, (os.getpid(), signal.SIGUSR1)).start()
+        self.queue.sleep(0.2)
+        self.assert_(time.time() - started >= 0.2)
+        self.assertEquals(["usr1"], self.calls)
+
+    def test_thread(self):
+        self.queue.start()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        deadline = time.time() + 1
+        while not self.calls and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(["usr1"], self.calls)
+
+if __name__ == "__main__":
+    unittest.main()
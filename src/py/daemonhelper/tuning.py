@@ -0,0 +1,182 @@
+"""
+tuning.py
+
+All classes/definitions in this file should pertain to the process resource
+settings (CPU affinity, priorities, rlimits, OOM score, cgroup) a daemon
+applies to itself from the [daemon] section of its config.
+"""
+import os
+import errno
+import resource
+
+from daemonhelper.procutil import (sched_setaffinity, sched_getaffinity, setpriority, getpriority,
+        sched_setscheduler, sched_getscheduler, ioprio_set, ioprio_get, SCHED_POLICIES, IOPRIO_CLASSES)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+RLIMITS = {
+    "rlimit_nofile" : resource.RLIMIT_NOFILE,
+    "rlimit_nproc"  : resource.RLIMIT_NPROC,
+    "rlimit_core"   : resource.RLIMIT_CORE,
+}
+
+def to_cpus(value):
+    """Transform for CPU lists like 0-3,6 into a sorted list of CPUs."""
+    cpus = set()
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        first, _, last = item.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    if not cpus:
+        raise ValueError("No CPUs in %r" % value)
+    return sorted(cpus)
+
+def _limit(value):
+    value = value.strip().lower()
+    if value in ("unlimited", "infinity"):
+        return resource.RLIM_INFINITY
+    return int(value)
+
+def to_rlimit(value):
+    """Transform for rlimits: <soft>:<hard>, or one value for both; unlimited allowed."""
+    soft, _, hard = value.partition(":")
+    return _limit(soft), _limit(hard or soft)
+
+def to_ionice(value):
+    """Transform for I/O priorities: idle, best-effort[:0-7] or realtime[:0-7]."""
+    name, _, level = value.strip().lower().partition(":")
+    if name not in IOPRIO_CLASSES:
+        raise ValueError("Unknown I/O class %r" % name)
+    level = int(level or (name == "best-effort" and 4 or 0))
+    if not 0 <= level <= 7:
+        raise ValueError("I/O priority level %d out of 0-7" % level)
+    return IOPRIO_CLASSES[name], level
+
+def to_sched_policy(value):
+    """Transform for scheduler policies: other, batch, idle, fifo or rr."""
+    value = value.strip().lower()
+    if value not in SCHED_POLICIES:
+        raise ValueError("Unknown scheduler policy %r" % value)
+    return SCHED_POLICIES[value]
+
+class Tuning(object):
+    """
+    Read the tuning options of a config and apply them to this process,
+    reading back every value the kernel reports so a silently ignored
+    setting is caught. All of them are inherited across fork and by new
+    threads, and several need root, so they are applied before
+    handle_prerun and _drop_privileges.
+    """
+    def __init__(self, config):
+        self.cpu_affinity = config("daemon", "cpu_affinity", None, transform=to_cpus)
+        self.nice = config("daemon", "nice", None, transform=int)
+        self.ionice = config("daemon", "ionice", None, transform=to_ionice)
+        self.sched_policy = config("daemon", "sched_policy", None, transform=to_sched_policy)
+        self.sched_priority = config("daemon", "sched_priority", 0, transform=int)
+        self.rlimits = dict((name, config("daemon", name, None, transform=to_rlimit)) for name in RLIMITS)
+        self.oom_score_adj = config("daemon", "oom_score_adj", None, transform=int)
+        self.cgroup = config("daemon", "cgroup", None)
+        self.cgroup_cpu_max = config("daemon", "cgroup_cpu_max", None)
+        self.cgroup_memory_max = config("daemon", "cgroup_memory_max", None)
+
+    def apply(self, logger):
+        """
+        Apply every configured option, in an order where earlier steps
+        can't undo later ones (the cgroup first, affinity last).
+        @return {option: value read back} of what was applied
+        """
+        applied = {}
+        if self.cgroup:
+            applied["cgroup"] = self._verify("cgroup", "/" + self.cgroup.strip("/"), self._join_cgroup(), logger)
+        for name, resource_id in sorted(RLIMITS.iteritems()):
+            if self.rlimits[name] is not None:
+                resource.setrlimit(resource_id, self.rlimits[name])
+                applied[name] = self._verify(name, self.rlimits[name], resource.getrlimit(resource_id), logger)
+        if self.oom_score_adj is not None:
+            with open("/proc/self/oom_score_adj", "w") as fd:
+                fd.write(str(self.oom_score_adj))
+            with open("/proc/self/oom_score_adj") as fd:
+                applied["oom_score_adj"] = self._verify("oom_score_adj", self.oom_score_adj,
+                        int(fd.read()), logger)
+        if self.sched_policy is not None:
+            sched_setscheduler(self.sched_policy, self.sched_priority)
+            applied["sched_policy"] = self._verify("sched_policy", (self.sched_policy, self.sched_priority),
+                    sched_getscheduler(), logger)
+        if self.nice is not None:
+            setpriority(self.nice)
+            applied["nice"] = self._verify("nice", self.nice, getpriority(), logger)
+        if self.ionice is not None:
+            ioprio_set(*self.ionice)
+            applied["ionice"] = self._verify("ionice", self.ionice, ioprio_get(), logger)
+        if self.cpu_affinity is not None:
+            sched_setaffinity(0, self.cpu_affinity)
+            applied["cpu_affinity"] = self._verify("cpu_affinity", self.cpu_affinity,
+                    sorted(sched_getaffinity(0)), logger)
+        if applied:
+            logger.info("Tuning applied: %s" % ", ".join("%s=%s" % item for item in sorted(applied.iteritems())))
+        return applied
+
+    def _verify(self, name, wanted, actual, logger):
+        if isinstance(wanted, list):
+            wanted, actual = tuple(wanted), tuple(actual)
+        if wanted != actual:
+            logger.warning("Tuning %s: asked for %s, the kernel reports %s" % (name, wanted, actual))
+        return actual
+
+    def _join_cgroup(self):
+        """Create the cgroup if needed, set its limits and move this process into it."""
+        path = os.path.join(CGROUP_ROOT, self.cgroup.lstrip("/"))
+        try:
+            os.mkdir(path, 0755)
+        except OSError as ex:
+            if ex.args[0] != errno.EEXIST:
+                raise
+        for filename, value in [("cpu.max", self.cgroup_cpu_max), ("memory.max", self.cgroup_memory_max)]:
+            if value is None:
+                continue
+            limit_path = os.path.join(path, filename)
+            if not os.path.exists(limit_path):
+                raise OSError(errno.ENOENT, "%s missing: is the controller enabled in the parent's "
+                        "cgroup.subtree_control?" % limit_path)
+            with open(limit_path, "w") as fd:
+                fd.write(value)
+        with open(os.path.join(path, "cgroup.procs"), "w") as fd:
+            fd.write(str(os.getpid()))
+        return current_cgroup()
+
+def current_cgroup():
+    """This process's cgroup v2 path, from /proc/self/cgroup."""
+    with open("/proc/self/cgroup") as fd:
+        for line in fd:
+            if line.startswith("0::"):
+                return line[3:].strip()
+    return None
+
+import unittest
+
+class TestTuning(unittest.TestCase):
+    def test_to_cpus(self):
+        self.assertEquals([0, 1, 2, 3, 6], to_cpus("0-3, 6"))
+        self.assertEquals([2], to_cpus("2"))
+        self.assertRaises(ValueError, to_cpus, "")
+
+    def test_to_rlimit(self):
+        self.assertEquals((1024, 4096), to_rlimit("1024:4096"))
+        self.assertEquals((65536, 65536), to_rlimit("65536"))
+        self.assertEquals((0, resource.RLIM_INFINITY), to_rlimit("0:unlimited"))
+
+    def test_to_ionice(self):
+        self.assertEquals((IOPRIO_CLASSES["best-effort"], 4), to_ionice("best-effort"))
+        self.assertEquals((IOPRIO_CLASSES["realtime"], 2), to_ionice("Realtime:2"))
+        self.assertEquals((IOPRIO_CLASSES["idle"], 0), to_ionice("idle"))
+        self.assertRaises(ValueError, to_ionice, "best-effort:9")
+        self.assertRaises(ValueError, to_ionice, "fast")
+
+    def test_unset(self):
+        self.assertEquals({}, Tuning(lambda section, option, default=None, transform=str: default)
+                .apply(None))
+
+if __name__ == "__main__":
+    unittest.main()
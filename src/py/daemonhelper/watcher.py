@@ -0,0 +1,230 @@
+"""
+watcher.py
+
+All classes/definitions in this file should pertain to noticing changes to
+a daemon's configuration files.
+"""
+import os
+import time
+import errno
+import select
+import threading
+
+from daemonhelper.config import _stat_signature
+from daemonhelper.procutil import module_available
+
+# pyinotify is imported by the first watcher, not by importing daemonhelper
+_USE_PYINOTIFY = module_available("pyinotify")
+
+class ConfigWatcher(object):
+    """
+    Watch config files and drop-in directories, and call callback once per
+    burst of changes, after debounce seconds without further events.
+
+    With pyinotify the parent directories are watched, so saves that write
+    a temporary file and rename it over the original are noticed as well as
+    in-place writes. Without pyinotify the stat signatures of every watched
+    path are polled every poll_interval seconds.
+
+    Either call start() to run on a background thread, or register fileno()
+    (when it is not None) with an event loop, call process() when it is
+    readable, and call process() again after timeout() seconds.
+    """
+    def __init__(self, paths, callback, debounce=0.25, poll_interval=1.0):
+        self.paths = [os.path.abspath(path) for path in paths if path]
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._pending_since = None
+        self._last_event = None
+        self._thread = None
+        self._running = False
+        if _USE_PYINOTIFY:
+            import pyinotify
+            self._inotify_mask = (pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB |
+                    pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO |
+                    pyinotify.IN_MOVED_FROM)
+            self._wm = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(self._wm, self._on_event, timeout=0)
+            self._watched_dirs = set()
+            self._add_watches()
+        else:
+            self._wm = None
+            self._snapshot = self._take_snapshot()
+            self._next_poll = time.time() + poll_interval
+
+    # INOTIFY
+
+    def _add_watches(self):
+        """Watch each path's parent directory, and each path that is a directory."""
+        dirs = set(os.path.dirname(path) for path in self.paths)
+        dirs.update(path for path in self.paths if os.path.isdir(path))
+        for directory in dirs - self._watched_dirs:
+            if os.path.isdir(directory):
+                self._wm.add_watch(directory, self._inotify_mask)
+                self._watched_dirs.add(directory)
+
+    def _on_event(self, event):
+        if event.pathname in self.paths or event.path in self.paths:
+            if event.dir and event.pathname in self.paths:
+                self._add_watches()
+            self._mark()
+
+    # STAT POLLING
+
+    def _take_snapshot(self):
+        snapshot = []
+        for path in self.paths:
+            snapshot.append((path, _stat_signature(path)))
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    child = os.path.join(path, name)
+                    snapshot.append((child, _stat_signature(child)))
+        return snapshot
+
+    def _poll_stat(self):
+        now = time.time()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + self.poll_interval
+        snapshot = self._take_snapshot()
+        if snapshot != self._snapshot:
+            self._snapshot = snapshot
+            self._mark()
+
+    # EVENT LOOP INTEGRATION
+
+    def _mark(self):
+        now = time.time()
+        if self._pending_since is None:
+            self._pending_since = now
+        self._last_event = now
+
+    def fileno(self):
+        """The inotify fd to poll for readability, or None when polling stat."""
+        if self._wm is None:
+            return None
+        return self._wm.get_fd()
+
+    def timeout(self):
+        """Seconds until process() has work to do without fd activity."""
+        deadlines = []
+        if self._last_event is not None:
+            deadlines.append(self._last_event + self.debounce)
+        if self._wm is None:
+            deadlines.append(self._next_poll)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.time())
+
+    def process(self):
+        """Drain pending events and fire the callback if a burst has settled."""
+        if self._wm is not None:
+            if self._notifier.check_events(0):
+                self._notifier.read_events()
+                self._notifier.process_events()
+        else:
+            self._poll_stat()
+        if self._last_event is not None and time.time() - self._last_event >= self.debounce:
+            self._pending_since = self._last_event = None
+            self.callback()
+
+    # BACKGROUND THREAD
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="config-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(self.poll_interval + self.debounce)
+        if self._wm is not None:
+            self._notifier.stop()
+
+    def _run(self):
+        fd = self.fileno()
+        while self._running:
+            timeout = self.timeout()
+            if timeout is None:
+                timeout = self.poll_interval
+            if fd is not None:
+                try:
+                    select.select([fd], [], [], timeout)
+                except select.error as ex:
+                    if ex.args[0] != errno.EINTR:
+                        raise
+            else:
+                time.sleep(timeout)
+            self.process()
+
+import unittest, tempfile, shutil
+
+class TestConfigWatcher(unittest.TestCase):
+    use_pyinotify = _USE_PYINOTIFY
+
+    def setUp(self):
+        global _USE_PYINOTIFY
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.conf")
+        self.dropins = os.path.join(self.directory, "test")
+        os.mkdir(self.dropins)
+        self._write(self.path, "[a]\nb: 1\n")
+        self.calls = []
+        use_pyinotify, _USE_PYINOTIFY = _USE_PYINOTIFY, self.use_pyinotify
+        try:
+            self.watcher = ConfigWatcher([self.path, self.dropins], lambda: self.calls.append(time.time()),
+                    debounce=0.1, poll_interval=0.05)
+        finally:
+            _USE_PYINOTIFY = use_pyinotify
+        self.assertEquals(self.use_pyinotify, self.watcher.fileno() is not None)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.directory)
+
+    def _write(self, path, text):
+        with open(path, "w") as fd:
+            fd.write(text)
+
+    def _settle(self):
+        time.sleep(0.4)
+
+    def test_debounce(self):
+        for i in range(5):
+            time.sleep(0.02)
+            self._write(self.path, "[a]\nb: %d\n" % i)
+            written = time.time()
+        self._settle()
+        self.assertEquals(1, len(self.calls))
+        self.assert_(self.calls[0] - written >= 0.1 - 0.01)
+
+    def test_rename_replace(self):
+        self._write(self.path + ".tmp", "[a]\nb: 2\n")
+        os.rename(self.path + ".tmp", self.path)
+        self._settle()
+        self.assertEquals(1, len(self.calls))
+
+    def test_delete(self):
+        os.unlink(self.path)
+        self._settle()
+        self.assertEquals(1, len(self.calls))
+
+    def test_dropin(self):
+        self._write(os.path.join(self.dropins, "10-extra.conf"), "[c]\nd: 1\n")
+        self._settle()
+        self.assertEquals(1, len(self.calls))
+
+    def test_unrelated(self):
+        self._write(os.path.join(self.directory, "other.conf"), "[e]\nf: 1\n")
+        self._settle()
+        self.assertEquals([], self.calls)
+
+class TestConfigWatcherPolling(TestConfigWatcher):
+    use_pyinotify = False
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,62 +1,696 @@
 from base import make_main, Daemon
-import os, subprocess, signal, time
+from config import to_bool, to_duration
+from procutil import sched_setaffinity, sched_getaffinity
+from handlers import handle_batch
+import os, subprocess, signal, time, errno, fcntl, select, shlex, random, logging, collections
 
-def create_wrapper_class(script_path, daemon_name=None, script_args=(), autorestart=0):
+class _Poller(object):
+    """Readability poller on top of epoll, falling back to poll."""
+    READ = select.POLLIN | select.POLLPRI
+    CLOSED = select.POLLHUP | select.POLLERR | select.POLLNVAL
+
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._scale = 1.0
+        else:
+            self._poller = select.poll()
+            self._scale = 1000.0
+        self._owners = {}
+
+    def register(self, fd, owner):
+        self._poller.register(fd, self.READ)
+        self._owners[fd] = owner
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+        del self._owners[fd]
+
+    def poll(self, timeout):
+        """Return (owner, fd) for every readable or closed fd."""
+        try:
+            events = self._poller.poll(timeout * self._scale)
+        except (IOError, OSError, select.error) as ex:
+            if ex.args[0] == errno.EINTR:
+                return []
+            raise
+        return [(self._owners[fd], fd) for fd, event in events if fd in self._owners]
+
+class OutputCapture(object):
+    """
+    Non-blocking, chunked reader that turns a child's output pipe into log
+    records. Each wakeup drains the pipe in large os.read calls, splits each
+    chunk into lines in a single pass and logs the lines with log_lines,
+    instead of one readline() and one logger call (with its caller lookup)
+    per line.
+    """
+    chunk_size = 65536
+    max_line = 1 << 20
+
+    def __init__(self, fd, logger, level=logging.INFO):
+        self.fd = fd
+        self.logger = logger
+        self.level = level
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._partial = ""
+
+    def read(self):
+        """
+        Log every complete line currently available.
+        @return False once the pipe has reached EOF
+        """
+        lines = []
+        alive = True
+        while True:
+            try:
+                chunk = os.read(self.fd, self.chunk_size)
+            except OSError as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                if ex.args[0] == errno.EAGAIN:
+                    break
+                raise
+            if not chunk:
+                alive = False
+                break
+            parts = chunk.split("\n")
+            if self._partial:
+                parts[0] = self._partial + parts[0]
+            self._partial = parts.pop()
+            if len(self._partial) > self.max_line:
+                parts.append(self._partial)
+                self._partial = ""
+            lines.extend(parts)
+            if len(chunk) < self.chunk_size:
+                break
+        if not alive and self._partial:
+            lines.append(self._partial)
+            self._partial = ""
+        if lines:
+            log_lines(self.logger, self.level, lines)
+        return alive
+
+def log_lines(logger, level, lines):
+    """
+    Log a batch of lines at one level, skipping blank lines. The level check
+    happens once per batch, the per-record caller lookup of Logger.log is
+    skipped since the lines did not come from our code, and each handler up
+    the logger hierarchy gets the whole batch at once through handle_batch,
+    so handlers with emit_batch (like TCPSysLogHandler) ship it in one go.
+    """
+    if logger.disabled or not logger.isEnabledFor(level):
+        return
+    make_record = logger.makeRecord
+    name = logger.name
+    records = [make_record(name, level, "(child)", 0, line, None, None)
+            for line in (line.rstrip() for line in lines) if line]
+    records = [record for record in records if logger.filter(record)]
+    if not records:
+        return
+    current = logger
+    while current:
+        for handler in current.handlers:
+            handle_batch(handler, records, flush=False)
+        if not current.propagate:
+            break
+        current = current.parent
+
+class RestartPolicy(object):
+    """
+    Decide when a crashed process is restarted. The first crash restarts it
+    at once; each further crash in a row waits delay * multiplier ** n
+    seconds, capped at max_delay and spread by +-jitter (a fraction). A
+    process that stayed up for window seconds counts as a fresh start. More
+    than max_crashes crashes within window seconds gives up (0 never does).
+    """
+    def __init__(self, delay=1, max_delay=60, multiplier=2, jitter=0.1, max_crashes=10, window=60):
+        self.configure(delay, max_delay, multiplier, jitter, max_crashes, window)
+        self.crashes = collections.deque()
+        self.consecutive = 0
+
+    def configure(self, delay=1, max_delay=60, multiplier=2, jitter=0.1, max_crashes=10, window=60):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_crashes = max_crashes
+        self.window = window
+
+    def crashed(self, uptime, now=None):
+        """
+        Record a crash after uptime seconds.
+        @return Seconds to wait before restarting, or None to give up
+        """
+        now = now or time.time()
+        self.crashes.append(now)
+        while self.crashes and self.crashes[0] <= now - self.window:
+            self.crashes.popleft()
+        if self.max_crashes and len(self.crashes) > self.max_crashes:
+            return None
+        if uptime >= self.window:
+            self.consecutive = 0
+        self.consecutive += 1
+        if self.consecutive == 1:
+            return 0.0
+        delay = min(self.max_delay, self.delay * self.multiplier ** (self.consecutive - 2))
+        return max(0.0, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def reset(self):
+        self.crashes.clear()
+        self.consecutive = 0
+
+def restart_options(config, program=None, delay=1):
+    """
+    RestartPolicy arguments from the [restart] section, overridden for one
+    program by [restart:<program>]:
+
+    [restart]
+    delay: <backoff after the second crash in a row>
+    max_delay: <longest backoff>
+    multiplier: <backoff growth per crash>
+    jitter: <random spread of each backoff, as a fraction>
+    max_crashes: <crashes within window before giving up, 0 for never>
+    window: <seconds the crashes are counted over>
+    """
+    sections = ["restart"] + (program and ["restart:%s" % program] or [])
+    options = {"delay": delay, "max_delay": 60, "multiplier": 2, "jitter": 0.1, "max_crashes": 10, "window": 60}
+    transforms = {"delay": to_duration, "max_delay": to_duration, "multiplier": float,
+            "jitter": float, "max_crashes": int, "window": to_duration}
+    for section in sections:
+        for name, transform in transforms.iteritems():
+            options[name] = config(section, name, options[name], transform=transform)
+    if options["window"] <= 0:
+        raise ValueError("[%s] window must be positive, not %g" % (sections[-1], options["window"]))
+    return options
+
+class _Child(object):
+    """A supervised command, its pipes and its restart schedule."""
+
+    def __init__(self, name, args, logger, policy, env=None, cpu=None):
+        self.name = name
+        self.args = args
+        self.logger = logger
+        self.policy = policy
+        self.env = env
+        self.cpu = cpu
+        self.process = None
+        self.pipes = {}
+        self.restart_at = 0
+        self.started_at = None
+        self.crashed_at = None
+        self.retired = False
+        self.failed = False
+
+    def start(self, poller):
+        self.started_at = time.time()
+        preexec = None
+        if self.cpu is not None:
+            preexec = lambda: sched_setaffinity(0, [self.cpu])
+        self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True, env=self.env, preexec_fn=preexec)
+        for pipe, level in [(self.process.stdout, logging.INFO), (self.process.stderr, logging.WARNING)]:
+            capture = OutputCapture(pipe.fileno(), self.logger, level)
+            self.pipes[capture.fd] = (pipe, capture)
+            poller.register(capture.fd, self)
+
+    def read(self, fd, poller):
+        pipe, capture = self.pipes[fd]
+        if not capture.read():
+            self.close(fd, poller)
+
+    def close(self, fd, poller):
+        pipe, capture = self.pipes.pop(fd)
+        capture.read()
+        poller.unregister(fd)
+        pipe.close()
+
+    def reap(self, poller):
+        """Return the exit code if the process is done, else None."""
+        if self.process is None:
+            return None
+        retval = self.process.poll()
+        if retval is not None:
+            for fd in list(self.pipes):
+                self.close(fd, poller)
+            self.process = None
+        return retval
+
+    def signal(self, signum):
+        if self.process is not None:
+            try:
+                os.kill(self.process.pid, signum)
+            except OSError:
+                pass
+
+class ChildSupervisor(Daemon):
+    """
+    Daemon running a set of child processes from _programs(), a dict of
+    name -> (args, env, cpu). All child stdout/stderr pipes are multiplexed
+    through one epoll loop and logged under <daemon name>.<child name>.
+    Each child is restarted independently following its RestartPolicy,
+    whose backoff delay defaults to autorestart seconds, unless
+    restart_children is off. A child that gives up stays down until the next SIGHUP, which
+    also starts, stops or restarts children to match _programs().
+    The supervisor runs until stopped, even with no programs to run.
+    """
+    autorestart = 1
+    restart_children = True
+    signal_dispatch = "loop"
+
+    def handle_prerun(self):
+        self._go = True
+        self._reload_pending = False
+        self._children = {}
+        self._poller = _Poller()
+
+    def handle_run(self):
+        self._poll_signals(self._poller)
+        self._sync_programs()
+        while self._go or self._running_children():
+            if self._reload_pending:
+                self._reload_pending = False
+                self._sync_programs()
+            self._start_due_children()
+            for owner, fd in self._poller.poll(self._poll_timeout()):
+                if owner is self._signals:
+                    self.dispatch_signals()
+                else:
+                    owner.read(fd, self._poller)
+            self._reap_children()
+
+    def _poll_signals(self, poller):
+        """Wake poller on SIGCHLD and on queued signals, to dispatch them from the loop."""
+        if self._signals is None:
+            signal.signal(signal.SIGCHLD, lambda *_: None)
+            return
+        self._signals.register(signal.SIGCHLD, None)
+        poller.register(self._signals.fileno(), self._signals)
+
+    def handle_stop(self, *_):
+        self._go = False
+        for child in self._children.itervalues():
+            child.signal(signal.SIGTERM)
+
+    def handle_update(self):
+        Daemon.handle_update(self)
+        self._reload_pending = True
+
+    def _programs(self):
+        raise NotImplementedError()
+
+    def _restart_policy_options(self, name):
+        return restart_options(self.config, name, delay=self.autorestart)
+
+    def _sync_programs(self):
+        if not self._go:
+            return
+        programs = self._programs()
+        for name, child in self._children.items():
+            if programs.get(name) == (child.args, child.env, child.cpu):
+                child.policy.configure(**self._restart_policy_options(name))
+                if child.failed:
+                    self.logger.info("%s: reloaded, trying again" % name)
+                    child.failed = False
+                    child.policy.reset()
+                    self._given_up(name).set(0)
+                continue
+            self.logger.info("%s: removed or changed, stopping" % name)
+            if child.process is None:
+                del self._children[name]
+            else:
+                child.signal(signal.SIGTERM)
+                child.retired = True
+        for name, (args, env, cpu) in programs.iteritems():
+            if name not in self._children:
+                self._children[name] = _Child(name, args,
+                        logging.getLogger("%s.%s" % (self.name, name)),
+                        RestartPolicy(**self._restart_policy_options(name)), env, cpu)
+
+    def _start_due_children(self):
+        now = time.time()
+        for child in self._children.itervalues():
+            if self._go and child.process is None and not child.failed and child.restart_at <= now:
+                self.logger.info("%s: starting %s" % (child.name, " ".join(child.args)))
+                child.start(self._poller)
+                if child.crashed_at is not None:
+                    self.metrics.counter("wrapper_child_restarts_total",
+                            "Restarts of wrapped processes", child=child.name).inc()
+                    self.metrics.histogram("wrapper_child_restart_seconds",
+                            "Seconds from a wrapped process exiting to its replacement starting",
+                            child=child.name).observe(child.started_at - child.crashed_at)
+                    child.crashed_at = None
+
+    def _reap_children(self):
+        for name, child in self._children.items():
+            retval = child.reap(self._poller)
+            if retval is None:
+                continue
+            if child.retired or not self._go or not self.restart_children:
+                self.logger.info("%s: exited with code %d" % (name, retval))
+                del self._children[name]
+                if self._go and child.retired:
+                    self._sync_programs()
+            else:
+                now = time.time()
+                delay = child.policy.crashed(now - child.started_at, now)
+                if delay is None:
+                    self.logger.critical("%s: died with code %d, %d crashes in %gs, giving up" %
+                            (name, retval, len(child.policy.crashes), child.policy.window))
+                    child.failed = True
+                    self._given_up(name).set(1)
+                    continue
+                self.logger.critical("%s: died unexpectedly with code %d, will restart in %.1fs" %
+                        (name, retval, delay))
+                child.crashed_at = now
+                child.restart_at = now + delay
+
+    def _given_up(self, name):
+        return self.metrics.gauge("wrapper_child_failed",
+                "1 while a program is down after too many crashes", child=name)
+
+    def _command_status(self):
+        status = Daemon._command_status(self)
+        status["programs"] = dict((name, {
+            "pid"      : child.process and child.process.pid,
+            "cpu"      : child.cpu,
+            "failed"   : child.failed,
+            "restarts" : self.metrics.counter("wrapper_child_restarts_total", child=name).value,
+        }) for name, child in self._children.iteritems())
+        return status
+
+    def _running_children(self):
+        return [child for child in self._children.itervalues() if child.process is not None]
+
+    def _poll_timeout(self):
+        pending = [child.restart_at for child in self._children.itervalues()
+                if child.process is None and not child.failed]
+        if not pending:
+            return 1.0
+        return min(1.0, max(0.0, min(pending) - time.time()))
+
+INSTANCE_ENV = "DAEMONHELPER_INSTANCE"
+INSTANCES_ENV = "DAEMONHELPER_INSTANCES"
+
+def create_wrapper_class(script_path, daemon_name=None, script_args=(), autorestart=0, instances=1, pin_cpus=False):
+    """
+    Create a daemon which runs one command and logs its output. With
+    autorestart the command is restarted whenever it exits, following a
+    RestartPolicy (see restart_options) whose backoff delay defaults to
+    autorestart seconds.
+
+    With more than one instance, that many copies of the command run under
+    one daemon, each restarted on its own, logged as <name>.<index> and
+    told its index and the instance count in $DAEMONHELPER_INSTANCE and
+    $DAEMONHELPER_INSTANCES. With pin_cpus each instance is bound to its
+    own CPU, round robin over the CPUs the daemon may use. Both can be
+    set in the config:
+
+    [wrapper]
+    instances: <count, or auto for one per usable CPU>
+    pin_cpus: <yes to bind each instance to one CPU>
+    """
     if autorestart:
         autorestart = int(autorestart)
 
-    class WrapperDaemon(Daemon):
+    class WrapperDaemon(ChildSupervisor):
         name = daemon_name or os.path.basename(script_path).split(".")[0]
-        
-        def handle_run(self):
+
+        def _args(self):
             args = [script_path]
             args.extend(script_args or ())
+            return args
+
+        def _instances(self):
+            count = self.config("wrapper", "instances", str(instances)).strip().lower()
+            if count == "auto":
+                return len(sched_getaffinity(0))
+            return max(1, int(count))
+
+        def _pinned(self):
+            return self.config("wrapper", "pin_cpus", pin_cpus, transform=to_bool)
+
+        def handle_run(self):
+            self._supervising = self._instances() > 1 or self._pinned()
+            if self._supervising:
+                return ChildSupervisor.handle_run(self)
+            self._run_single()
+
+        def _programs(self):
+            count = self._instances()
+            cpus = self._pinned() and sorted(sched_getaffinity(0))
+            programs = {}
+            for index in range(count):
+                env = dict(os.environ)
+                env[INSTANCE_ENV] = str(index)
+                env[INSTANCES_ENV] = str(count)
+                cpu = cpus[index % len(cpus)] if cpus else None
+                programs[str(index)] = (self._args(), env, cpu)
+            return programs
+
+        def _restart_policy_options(self, name):
+            return restart_options(self.config, delay=autorestart)
+
+        def _reap_children(self):
+            ChildSupervisor._reap_children(self)
+            # Instances are not restarted without autorestart, so the
+            # wrapper is done once all of them have exited
+            if not self._children:
+                self._go = False
+
+        def _run_single(self):
+            args = self._args()
             
-            self._go = True
+            policy = autorestart and RestartPolicy(**restart_options(self.config, delay=autorestart))
+            restarts = self.metrics.counter("wrapper_child_restarts_total",
+                    "Restarts of wrapped processes", child=self.name)
+            restart_time = self.metrics.histogram("wrapper_child_restart_seconds",
+                    "Seconds from a wrapped process exiting to its replacement starting", child=self.name)
+            crashed_at = None
+
+            poller = _Poller()
+            self._poll_signals(poller)
             while self._go:
                 self._go = bool(autorestart)
 
+                started = time.time()
                 self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                if crashed_at is not None:
+                    restarts.inc()
+                    restart_time.observe(started - crashed_at)
 
-                while True:
-                    try:
-                        line = self.process.stdout.readline()
-                    except IOError:
-                        break
-
-                    if not line:
-                        break
-                    
-                    line = line.rstrip()
-                    if not line:
-                        continue
-
-                    self.logger.info(line)
+                capture = OutputCapture(self.process.stdout.fileno(), self.logger)
+                poller.register(capture.fd, capture)
+                while capture.read():
+                    for owner, fd in poller.poll(1.0):
+                        if owner is self._signals:
+                            self.dispatch_signals()
+                poller.unregister(capture.fd)
+                self.process.stdout.close()
 
                 retval = self.process.wait()
                 
                 if self._go:
-                    self.logger.critical("process died unexpectedly with code %d, will restart in %ds" % (retval, autorestart))
-                    time.sleep(autorestart)
+                    crashed_at = time.time()
+                    delay = policy.crashed(crashed_at - started, crashed_at)
+                    if delay is None:
+                        self.logger.critical("process died with code %d, %d crashes in %gs, giving up" %
+                                (retval, len(policy.crashes), policy.window))
+                        raise SystemExit(retval or 1)
+                    self.logger.critical("process died unexpectedly with code %d, will restart in %.1fs" % (retval, delay))
+                    # Back off on the poller, so a stop interrupts the wait
+                    deadline = crashed_at + delay
+                    while self._go and time.time() < deadline:
+                        for owner, fd in poller.poll(min(1.0, deadline - time.time())):
+                            if owner is self._signals:
+                                self.dispatch_signals()
 
                 elif retval != 0:
                     raise SystemExit(retval)
 
         def handle_stop(self, *_):
+            if getattr(self, "_supervising", False):
+                return ChildSupervisor.handle_stop(self)
             self._go = False
             try:
                 os.kill(self.process.pid, signal.SIGTERM)
-            except OSError:
+            except (AttributeError, OSError):
                 pass
 
+        def handle_update(self):
+            if getattr(self, "_supervising", False):
+                return ChildSupervisor.handle_update(self)
+            Daemon.handle_update(self)
+
+    WrapperDaemon.autorestart = autorestart
+    WrapperDaemon.restart_children = bool(autorestart)
     return WrapperDaemon
 
-def make_wrapper_main(script_path, daemon_name=None, script_args=(), autorestart=0):
-    daemon_obj = create_wrapper_class(script_path, daemon_name, script_args, autorestart)
+def make_wrapper_main(script_path, daemon_name=None, script_args=(), autorestart=0, instances=1, pin_cpus=False):
+    daemon_obj = create_wrapper_class(script_path, daemon_name, script_args, autorestart, instances, pin_cpus)
     return make_main(daemon_obj)
 
-def exec_wrapper(script_path, daemon_name=None, script_args=(), autorestart=0):
-    make_wrapper_main(script_path, daemon_name, script_args, autorestart)()
+def exec_wrapper(script_path, daemon_name=None, script_args=(), autorestart=0, instances=1, pin_cpus=False):
+    make_wrapper_main(script_path, daemon_name, script_args, autorestart, instances, pin_cpus)()
+
+def create_supervisor_class(daemon_name, programs_section="programs", autorestart=1):
+    """
+    Create a daemon which supervises every command listed in one config
+    section, for example in /etc/<daemon_name>.conf:
+
+    [programs]
+    web: /usr/bin/webserver --port 8080
+    queue: /usr/bin/queue-worker
+
+    Each program is a ChildSupervisor child: restarted independently
+    following its RestartPolicy (see restart_options, [restart:<program>]
+    overrides), and SIGHUP starts, stops or restarts children to match the
+    edited section.
+    """
+    class SupervisorDaemon(ChildSupervisor):
+        name = daemon_name
+
+        def _programs(self):
+            section = self.config[programs_section]
+            return dict((option.name, (shlex.split(option.get()), None, None))
+                    for option in section if option.in_config_file)
+
+    SupervisorDaemon.autorestart = int(autorestart)
+    return SupervisorDaemon
+
+def make_supervisor_main(daemon_name, programs_section="programs", autorestart=1):
+    daemon_obj = create_supervisor_class(daemon_name, programs_section, autorestart)
+    return make_main(daemon_obj)
+
+def exec_supervisor(daemon_name, programs_section="programs", autorestart=1):
+    make_supervisor_main(daemon_name, programs_section, autorestart)()
+
+import unittest, tempfile, shutil, threading
+from base import make_test_daemon
+
+class TestOutputCapture(unittest.TestCase):
+    def test_batch(self):
+        batches = []
+        handler = logging.Handler()
+        handler.emit_batch = lambda records: batches.append([record.getMessage() for record in records])
+        logger = logging.getLogger("test-output-capture")
+        logger.addHandler(handler)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        read_fd, write_fd = os.pipe()
+        try:
+            capture = OutputCapture(read_fd, logger)
+            os.write(write_fd, "one\ntwo\n\nthr")
+            self.assertEquals(True, capture.read())
+            os.write(write_fd, "ee\n")
+            os.close(write_fd)
+            self.assertEquals(True, capture.read())
+            self.assertEquals(False, capture.read())
+        finally:
+            os.close(read_fd)
+            logger.removeHandler(handler)
+        self.assertEquals([["one", "two"], ["three"]], batches)
+
+class TestRestartPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = RestartPolicy(delay=1, max_delay=8, multiplier=2, jitter=0, max_crashes=5, window=60)
+
+    def test_backoff(self):
+        delays = [self.policy.crashed(0.1, 1000 + i) for i in range(5)]
+        self.assertEquals([0.0, 1, 2, 4, 8], delays)
+
+    def test_reset_after_uptime(self):
+        self.policy.crashed(0.1, 1000)
+        self.assertEquals(1, self.policy.crashed(0.1, 1001))
+        self.assertEquals(0.0, self.policy.crashed(120, 1200))
+        self.assertEquals(1, self.policy.crashed(0.1, 1201))
+
+    def test_give_up(self):
+        for i in range(5):
+            self.assertNotEquals(None, self.policy.crashed(0.1, 1000 + i))
+        self.assertEquals(None, self.policy.crashed(0.1, 1005))
+        self.assertNotEquals(None, RestartPolicy(max_crashes=0, jitter=0).crashed(0.1, 1006))
+
+    def test_window(self):
+        self.assertEquals(0.0, RestartPolicy(window=0).crashed(0.1))
+        options = {("restart", "window"): "0"}
+        config = lambda section, name, default=None, transform=str: \
+                transform(options[section, name]) if (section, name) in options else default
+        self.assertRaises(ValueError, restart_options, config)
+
+class TestChildSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.programs = programs = {}
+        class Supervisor(ChildSupervisor):
+            name = "test_supervisor"
+            def _programs(self):
+                return dict(programs)
+        self.daemon = make_test_daemon(Supervisor, self.directory)
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        shutil.rmtree(self.directory)
+
+    def _run(self, daemon, stop_after=None):
+        """Run daemon's handle_run, stopping it after stop_after seconds; return the seconds it ran."""
+        timer = stop_after is not None and threading.Timer(stop_after, daemon.handle_stop)
+        if timer:
+            timer.start()
+        started = time.time()
+        daemon.handle_prerun()
+        try:
+            daemon.handle_run()
+        finally:
+            if timer:
+                timer.cancel()
+        return time.time() - started
+
+    def test_no_programs(self):
+        self.assert_(self._run(self.daemon, 0.3) >= 0.3)
+
+    def test_reload_removes_all(self):
+        self.programs["sleeper"] = (["sleep", "30"], None, None)
+        running = []
+        def remove():
+            running.extend(child.name for child in self.daemon._running_children())
+            self.programs.clear()
+            self.daemon.handle_update()
+        threading.Timer(0.2, remove).start()
+        self.assert_(self._run(self.daemon, 1.5) >= 1.5)
+        self.assertEquals(["sleeper"], running)
+        self.assertEquals({}, self.daemon._children)
+
+    def test_wrapper_stop_during_backoff(self):
+        wrapper = make_test_daemon(create_wrapper_class("/bin/false", "test_wrapper", autorestart=1),
+                self.directory, "[restart]\ndelay: 30\njitter: 0\n")
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                wrapper.foreground()
+                code = 0
+            finally:
+                os._exit(code)
+        try:
+            # The second crash in a row backs off for 30s
+            deadline = time.time() + 5
+            while not wrapper.status and time.time() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.5)
+            started = time.time()
+            wrapper.stop(5)
+            self.assert_(time.time() - started < 2)
+        finally:
+            # A no-op on an exited child, which keeps its exit status
+            os.kill(pid, signal.SIGKILL)
+            _, status = os.waitpid(pid, 0)
+        self.assertEquals(True, os.WIFEXITED(status))
+        self.assertEquals(0, os.WEXITSTATUS(status))
+
+    def test_wrapper_instances_exit(self):
+        wrapper = make_test_daemon(create_wrapper_class("/bin/true", "test_wrapper", instances=2), self.directory)
+        self.assert_(self._run(wrapper, 5) < 1)
 
 if __name__ == "__main__":
     exec_wrapper("/bin/sleep", "sleeper", ("2",), 3)